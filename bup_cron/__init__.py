@@ -9,7 +9,9 @@ options can also be specified, without --, in %s. an
 arbitrary configuration file may also be supplied on the
 commandline with a @ prefix (e.g. @foo.conf).
 
-at least path and repo need to be specified."""
+at least path and repo need to be specified. `bup-cron stats` queries
+the --stats-db database instead, use ./stats to back up a directory
+named stats."""
 
 __version_info__ = ("2", "0")
 __version__ = ".".join(__version_info__)
@@ -34,33 +36,187 @@ License along with this program. If not, see
 <http://www.gnu.org/licenses/>.
 """
 
+# only modules needed on every invocation are imported here, the
+# others are imported where they are used to keep startup fast, see
+# the importtime test in t/test-bup-cron.sh
 import argparse
+import contextlib
 import datetime
 import errno
-import locale
+import functools
 import logging
-import logging.handlers
 import os
-import platform
 import re
-import socket
-import stat
 import subprocess
 import sys
-import traceback
+import threading
+import time
 
 global_logger = None
+profiler = None
+
+
+class Profiler(object):
+    """profile bup-cron's own work, for --profile
+
+    every phase gets its own cProfile profile, dumped to PHASE.pstats:
+    a phase entered while another one runs pauses the outer one, so
+    the time of nested phases is not counted twice. the wall time of
+    the commands ran through check_call() is also recorded under the
+    stack of phases running them, in the collapsed stack format
+    flamegraph.pl, inferno or speedscope render.
+
+    the stack of phases is kept per thread, but only the main thread
+    is profiled: worker threads, like those of --parallel-paths, only
+    account the commands they run."""
+
+    class State(threading.local):
+        def __init__(self):
+            self.stack = []
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.profiles = {}
+        self.state = Profiler.State()
+        self.children = {}
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        import cProfile
+
+        stack = self.state.stack
+        if threading.current_thread() is not threading.main_thread():
+            stack.append(name)
+            try:
+                yield
+            finally:
+                stack.pop()
+            return
+        if stack:
+            self.profiles[stack[-1]].disable()
+        profile = self.profiles.setdefault(name, cProfile.Profile())
+        stack.append(name)
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            stack.pop()
+            if stack:
+                self.profiles[stack[-1]].enable()
+
+    def child(self, cmd, seconds):
+        """account seconds spent in the command cmd"""
+        name = os.path.basename(cmd[0])
+        if name in ("bup", "git"):
+            args = [a for a in cmd[1:] if not a.startswith("-")]
+            if args:
+                name += " " + args[0]
+        stack = ";".join(["bup-cron"] + self.state.stack + [name])
+        with self.lock:
+            self.children[stack] = self.children.get(stack, 0) + seconds
+
+    def fork(self, name):
+        """start over in a subdirectory, for job processes"""
+        self.__init__(os.path.join(self.directory, name))
+
+    def close(self):
+        """write the profiles out"""
+        make_dirs_helper(self.directory)
+        for name, profile in self.profiles.items():
+            profile.dump_stats(os.path.join(self.directory, "%s.pstats" % name))
+        with open(os.path.join(self.directory, "children.folded"), "w") as f:
+            for stack, seconds in sorted(self.children.items()):
+                # in microseconds, as counts must be integers
+                f.write("%s %d\n" % (stack, seconds * 1e6))
+        logging.info("profiles written to %s", self.directory)
+
+
+def profiled(phase):
+    """decorator running the function as a phase
+
+    phases are named in structured logs, and profiled with --profile"""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            LogContext.state.phases.append(phase)
+            try:
+                if profiler is None:
+                    return func(*args, **kwargs)
+                with profiler.phase(phase):
+                    return func(*args, **kwargs)
+            finally:
+                LogContext.state.phases.pop()
+
+        return wrapper
+
+    return decorator
+
+
+class LogContext(logging.Filter):
+    """add what bup-cron is working on to log records
+
+    the phase comes from the innermost @profiled function running, the
+    other fields (path, branch) are set in the fields dict while they
+    apply. fields given explicitly with extra= are kept. both are kept
+    per thread, as paths may be saved in parallel."""
+
+    class State(threading.local):
+        def __init__(self):
+            self.phases = []
+            self.fields = {}
+
+    state = State()
+
+    def filter(self, record):
+        phases = self.state.phases
+        if phases and not hasattr(record, "phase"):
+            record.phase = phases[-1]
+        for name, value in self.state.fields.items():
+            if not hasattr(record, name):
+                setattr(record, name, value)
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """format records as one JSON object per line, for --log-format=json
+
+    prefix is formatted with the record attributes and prepended, for
+    syslog"""
+
+    fields = ("phase", "path", "branch", "command", "duration", "rc")
+
+    def __init__(self, prefix=""):
+        logging.Formatter.__init__(self)
+        self.prefix = prefix
+
+    def format(self, record):
+        import json
+
+        data = {
+            "time": datetime.datetime.fromtimestamp(record.created)
+            .astimezone()
+            .isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "message": record.getMessage(),
+            "process": record.process,
+        }
+        for name in self.fields:
+            value = getattr(record, name, None)
+            if value is not None:
+                data[name] = value
+        if record.exc_info:
+            data["exception"] = self.formatException(record.exc_info)
+        return self.prefix % record.__dict__ + json.dumps(data, default=str)
 
 
 class ArgumentConfigParser(argparse.ArgumentParser):
     configs = ["/etc/bup-cron.conf", "~/.bup-cron.conf", "~/.config/bup-cron.conf"]
-    snapshot_names = ["LVM", "NO"]
     pidfile = ".bup-cron.pid"
 
     def __init__(self):
-        if sys.platform.startswith("cygwin"):
-            self.snapshot_names += ["VSS"]
-
         """various settings for the argument parser"""
         argparse.ArgumentParser.__init__(
             self,
@@ -84,6 +240,15 @@ class ArgumentConfigParser(argparse.ArgumentParser):
                     mostly useful for the configuration
                     file""",
         )
+        group.add_argument(
+            "--paths-from",
+            action="append",
+            default=[],
+            metavar="FILE",
+            help="""read paths to backup from FILE, one per
+                    line, or from stdin with -. paths are read
+                    as the backup goes, not all at once""",
+        )
         if "BUP_DIR" in os.environ:
             defdir = os.environ["BUP_DIR"]
         else:
@@ -117,6 +282,16 @@ class ArgumentConfigParser(argparse.ArgumentParser):
             help="""a SSH address to save the backup remotely
                     (example: bup@example.com:repos/repo.bup)""",
         )
+        group.add_argument(
+            "--pipe",
+            action="append",
+            default=[],
+            metavar="NAME=COMMAND",
+            help="""back up the output of a shell command, e.g.
+                    a database dump, streamed into bup split
+                    without temporary files, in a branch named
+                    after NAME""",
+        )
         group.add_argument(
             "-x",
             "--exclude",
@@ -142,6 +317,63 @@ class ArgumentConfigParser(argparse.ArgumentParser):
             help="""read --exclude-rx patterns from filename,
                     will be passed as --exclude-rx-from to bup""",
         )
+        group.add_argument(
+            "--exclude-caches",
+            action="store_true",
+            help="""exclude directories holding a CACHEDIR.TAG
+                    file, see https://bford.info/cachedir/""",
+        )
+        group.add_argument(
+            "--exclude-nodump",
+            action="store_true",
+            help="""exclude files and directories with the nodump
+                    attribute, set with chattr +d""",
+        )
+        group.add_argument(
+            "--engine",
+            choices=["subprocess", "library", "auto"],
+            default="subprocess",
+            help="""how to run bup index and save: as separate
+                    processes, or in the bup-cron process through
+                    bup's modules (bup 0.32 or later), which avoids
+                    loading bup again for every path. library
+                    fails if bup's modules cannot be loaded, auto
+                    falls back to processes. in-process commands
+                    cannot be killed, so library cannot be used with
+                    --timeout or --stall-timeout, and auto then runs
+                    processes. default: %(default)s""",
+        )
+        group.add_argument(
+            "--compress",
+            default=None,
+            metavar="auto|LEVEL",
+            type=parse_compress,
+            help="""compression level of bup save, from 0 to 9,
+                    or auto to tune it per repository from how
+                    CPU-bound previous saves were, default:
+                    bup's""",
+        )
+        group.add_argument(
+            "--pack-size-limit",
+            default=None,
+            metavar="SIZE",
+            help="""maximum size of the packs written to the
+                    repository, e.g. 1g, stored as pack.packSizeLimit
+                    in its git configuration""",
+        )
+        group.add_argument(
+            "--memory-high",
+            default=None,
+            metavar="SIZE",
+            help="""keep bup save and fsck from evicting the page
+                    cache of other programs: run them in a cgroup
+                    with that memory.high limit (e.g. 512M) with
+                    systemd-run, or else drop the files they read
+                    from the cache if they were not cached before.
+                    bup save then runs in a process, even with
+                    --engine library. fsck of a --remote repository
+                    runs on the server and is not limited""",
+        )
         group = self.add_argument_group(
             "Extra jobs",
             """Those are extra features that
@@ -154,6 +386,43 @@ class ArgumentConfigParser(argparse.ArgumentParser):
             help="""redo a full backup
                     (runs bup index --clear before starting)""",
         )
+        group.add_argument(
+            "--index-shards",
+            action="store_true",
+            help="""give each path its own index file, in
+                    $BUP_DIR/bupindex.d, instead of sharing
+                    $BUP_DIR/bupindex: indexing a path only
+                    rewrites its own index, and paths can be
+                    saved in parallel, see --parallel-paths""",
+        )
+        group.add_argument(
+            "--clear-path",
+            action="append",
+            default=[],
+            metavar="PATH",
+            help="""with --index-shards, clear the index of PATH
+                    only, to redo a full backup of it""",
+        )
+        group.add_argument(
+            "--parallel-paths",
+            type=int,
+            default=1,
+            metavar="N",
+            help="""with --index-shards, index and save up to N
+                    paths at once. paths are saved one at a time
+                    with --snapshot, --stats, --preflight,
+                    --compress auto, --profile or --engine
+                    library, which measure or share state across
+                    paths, default: %(default)s""",
+        )
+        group.add_argument(
+            "--preflight",
+            action="store_true",
+            help="""before saving each path, estimate how much
+                    the repository will grow from the files bup
+                    index found modified, and skip the path if
+                    that does not fit in the free space""",
+        )
         group.add_argument(
             "--parity",
             action="store_true",
@@ -169,27 +438,51 @@ class ArgumentConfigParser(argparse.ArgumentParser):
             action="store_true",
             help="""run fsck -r if fsck fails after backup, implies --check""",
         )
+        group.add_argument(
+            "--remote-queue",
+            default=None,
+            metavar="DIR",
+            help="""with --remote, do not wait for --check and
+                    --parity: queue them in DIR on the server, for
+                    bup-cron --server-worker DIR, and report how
+                    they went on the next run. DIR must be absolute
+                    or relative to the home directory on the server,
+                    ~ is not expanded""",
+        )
+        group.add_argument(
+            "--no-start-worker",
+            action="store_false",
+            dest="start_worker",
+            help="""with --remote-queue, do not start bup-cron
+                    --server-worker on the server after queueing,
+                    leave the jobs to a worker ran from its crontab""",
+        )
         group.add_argument(
             "-s",
             "--snapshot",
             nargs="?",
             default="NO",
             const="LVM",
-            choices=self.snapshot_names,
+            choices=sorted(Snapshot.backends),
             type=str.upper,
             help="""snapshot filesystem before backup.
                     this will automatically guess the
                     path to the logical volume, create a
                     snapshot, mount it, then remove it
                     when it is done, default: %(default)s,
-                    LVM if -s specified without argument""",
+                    LVM if -s specified without argument.
+                    LVMTHIN makes instant thin snapshots,
+                    FREEZE freezes filesystems without LVM
+                    with fsfreeze(8) during the backup""",
         )
         group.add_argument(
             "-z",
             "--size",
             action="store",
             default=Snapshot.size,
-            help="""size of the LVM snapshot,
+            help="""size of the LVM snapshot, or "auto" to
+                    size it from the write rate of the origin
+                    and the duration of previous backups,
                     defaults to %(default)s""",
         )
         group.add_argument(
@@ -202,12 +495,181 @@ class ArgumentConfigParser(argparse.ArgumentParser):
                     the VG and LV names, default:
                     %(default)s)""",
         )
+        group.add_argument(
+            "--verify-sample",
+            type=int,
+            default=0,
+            metavar="N",
+            help="""after each save, restore a random sample
+                    of N files, biased towards large files, and
+                    compare them with the source. the restore
+                    throughput is logged and recorded in stats""",
+        )
+        group.add_argument(
+            "--verify-dir",
+            default=None,
+            help="""scratch directory for --verify-sample, a
+                    tmpfs is recommended, defaults to $TMPDIR""",
+        )
+        group.add_argument(
+            "--verify-jobs",
+            type=int,
+            default=4,
+            metavar="N",
+            help="""number of parallel restores for --verify-sample,
+                    and of parallel bup fsck jobs for --verify-rotate,
+                    default: %(default)s""",
+        )
+        group.add_argument(
+            "--verify-rotate",
+            type=int,
+            default=0,
+            metavar="DAYS",
+            help="""fully verify a slice of the packs of the
+                    repository with bup fsck after each backup,
+                    oldest verified first, so that all of them
+                    are verified every DAYS days""",
+        )
+        group.add_argument(
+            "--verify-budget",
+            type=parse_duration,
+            default=None,
+            metavar="DURATION",
+            help="""stop --verify-rotate once this much time
+                    (e.g. 1h) was spent, the next run resumes
+                    where this one stopped""",
+        )
+        group.add_argument(
+            "--keep-daily",
+            type=int,
+            default=0,
+            metavar="N",
+            help="""retention policy: keep the last save of
+                    each of the last N days in the branches
+                    saved, older saves are removed with bup rm
+                    and bup gc after the backup""",
+        )
+        group.add_argument(
+            "--keep-weekly",
+            type=int,
+            default=0,
+            metavar="N",
+            help="""retention policy: keep the last save of
+                    each of the last N weeks""",
+        )
+        group.add_argument(
+            "--keep-monthly",
+            type=int,
+            default=0,
+            metavar="N",
+            help="""retention policy: keep the last save of
+                    each of the last N months""",
+        )
+        group.add_argument(
+            "--prune-budget",
+            type=parse_duration,
+            default=None,
+            metavar="DURATION",
+            help="""stop pruning and skip the garbage collection
+                    once this much time (e.g. 30m) was spent pruning""",
+        )
+        group.add_argument(
+            "--prune-dry-run",
+            action="store_true",
+            help="""only log the saves the retention policy
+                    would remove""",
+        )
+        group.add_argument(
+            "--maintain",
+            action="store_true",
+            help="""after the backup, combine pack indexes with
+                    bup midx --auto and update the bloom filter
+                    with bup bloom, to keep object lookups fast""",
+        )
+        group.add_argument(
+            "--maintain-budget",
+            type=parse_duration,
+            default=None,
+            metavar="DURATION",
+            help="""skip the remaining maintenance steps once
+                    this much time (e.g. 10m) was spent on it""",
+        )
+        group.add_argument(
+            "--timeout",
+            action="append",
+            type=parse_timeout,
+            default=[],
+            metavar="[PHASE=]DURATION",
+            help="""kill commands running for longer than
+                    DURATION, e.g. save=6h or fsck=2h for a
+                    single phase, or 12h for all of them. can
+                    be repeated""",
+        )
+        group.add_argument(
+            "--stall-timeout",
+            type=parse_duration,
+            default=None,
+            metavar="DURATION",
+            help="""kill commands that did no I/O, including
+                    their children like ssh, for that long
+                    (e.g. 30m). Linux only""",
+        )
+        group.add_argument(
+            "--stall-retries",
+            type=int,
+            default=1,
+            metavar="N",
+            help="""run commands killed by --timeout or
+                    --stall-timeout again, up to N times,
+                    default: %(default)s""",
+        )
+        group.add_argument(
+            "--interval",
+            action="append",
+            type=parse_interval,
+            default=[],
+            metavar="PATH=DURATION",
+            help="""save PATH (or the --pipe of that name) only
+                    once every DURATION, e.g. /var/mail=1h or
+                    /usr=1w, when bup-cron is ran more often by
+                    cron. other paths are saved on every run""",
+        )
+        group.add_argument(
+            "--jitter",
+            type=parse_duration,
+            default=3600,
+            metavar="DURATION",
+            help="""shift the --interval schedule of each path
+                    by up to DURATION, by a delay specific to
+                    the host, to spread the load of a fleet on a
+                    shared repository, default: 1h""",
+        )
+        group.add_argument(
+            "--ignore-schedule",
+            action="store_true",
+            help="""save every path now, even those that are
+                    not due according to --interval""",
+        )
         group.add_argument(
             "--stats",
             action="store_true",
             help="""save statistics about backups
                     as a git note""",
         )
+        group.add_argument(
+            "--stats-db",
+            action="store_true",
+            help="""also append statistics to a SQLite
+                    database, implies --stats,
+                    see `bup-cron stats -h`""",
+        )
+        group.add_argument(
+            "--stats-db-path",
+            default=None,
+            help="""location of the statistics database,
+                    defaults to $BUP_DIR/%s"""
+            % StatsDatabase.filename,
+        )
         group = self._optionals
         group.title = "Daemon and logging"
         group.description = """Those options define how bup-cron
@@ -238,6 +700,24 @@ class ArgumentConfigParser(argparse.ArgumentParser):
             help="""print debug backtrace on unhandled exceptions\
                     - by default only the message is printed""",
         )
+        group.add_argument(
+            "--log-format",
+            choices=["text", "json"],
+            default="text",
+            help="""format of the logs, json writes one object per
+                    line with the phase, path, branch, command,
+                    duration and rc fields when they apply,
+                    default: %(default)s""",
+        )
+        group.add_argument(
+            "--profile",
+            metavar="DIR",
+            default=None,
+            help="""profile bup-cron itself: write a cProfile
+                    PHASE.pstats file per phase in DIR, and the
+                    time spent in commands to DIR/children.folded,
+                    for flamegraph tools""",
+        )
         group.add_argument(
             "-l",
             "--logfile",
@@ -258,6 +738,35 @@ class ArgumentConfigParser(argparse.ArgumentParser):
                     logging, INFO if --syslog is specified without
                     argument""",
         )
+        group = self.add_argument_group(
+            "Jobs",
+            """Those options allow running multiple
+               backup jobs from a single bup-cron process""",
+        )
+        group.add_argument(
+            "--job-file",
+            action="append",
+            help="""run the jobs defined in this file instead of
+                    a single backup, see the README for the format""",
+        )
+        group.add_argument(
+            "--parallel-jobs",
+            type=int,
+            default=1,
+            metavar="N",
+            help="""run up to N jobs at once, jobs sharing a
+                    repository or taking snapshots never run
+                    concurrently, default: %(default)s""",
+        )
+        group.add_argument(
+            "--after",
+            action="append",
+            default=[],
+            metavar="JOB",
+            help="""in a job file, only start this job after JOB
+                    completed, and skip it if JOB failed""",
+        )
+        group = self._optionals
         group.add_argument(
             "--pidfile",
             default=None,
@@ -267,6 +776,14 @@ class ArgumentConfigParser(argparse.ArgumentParser):
                     $BUP_DIR/%s"""
             % self.pidfile,
         )
+        group.add_argument(
+            "--server-worker",
+            default=None,
+            metavar="QUEUE",
+            help="""on a repository server, run the checks
+                    clients queued in QUEUE with --remote-queue,
+                    then exit""",
+        )
 
     def convert_arg_line_to_args(self, arg_line):
         """parse a config file"""
@@ -277,23 +794,35 @@ class ArgumentConfigParser(argparse.ArgumentParser):
             # all lines are assumed to be options
             return ["--" + arg_line]
 
-    def parse_args(self):
+    def parse_args(self, argv=None):
         """Process arguments list
 
         Inject system and user config files and cleanup various
-        arguments and defaults that couldn't be done otherwise."""
-        configs = map(lambda x: os.path.expanduser(x), self.configs)
-        for conf in configs:
-            try:
-                with open(conf, "r"):
-                    sys.argv.insert(1, "@" + conf)
-            except IOError:
-                pass
-        args = argparse.ArgumentParser.parse_args(self)
+        arguments and defaults that couldn't be done otherwise.
+
+        argv is parsed as is if provided, this is used for jobs, see
+        JobRunner."""
+        if argv is None:
+            configs = map(lambda x: os.path.expanduser(x), self.configs)
+            if {"-h", "--help"} & set(sys.argv[1:]):
+                # help does not depend on the configuration
+                configs = []
+            for conf in configs:
+                try:
+                    with open(conf, "r"):
+                        sys.argv.insert(1, "@" + conf)
+                except IOError:
+                    pass
+        args = argparse.ArgumentParser.parse_args(self, argv)
         if args.copyright:
             self.exit(0, __license__)
         if args.version:
             self.exit(0, __version__ + "\n")
+        if args.job_file and argv is None:
+            # the jobs will be checked when they are loaded
+            return args
+        if args.server_worker and argv is None:
+            return args
         if "BUP_DIR" not in os.environ and not args.repository:
             self.error("argument -d/--repository is required")
 
@@ -307,13 +836,33 @@ class ArgumentConfigParser(argparse.ArgumentParser):
             args.paths += args.path
         # remove this one to avoid ambiguity
         del args.path
-        if len(args.paths) < 1:
+        if len(args.paths) < 1 and not args.pipe and not args.paths_from:
             self.error("argument paths is required")
-        os.environ["BUP_DIR"] = args.repository
-        # remove this one to avoid ambiguity
+        for filename in args.paths_from:
+            if filename != "-" and not os.access(filename, os.R_OK):
+                self.error("argument --paths-from: cannot read %s" % filename)
+        for pipe in args.pipe:
+            if not re.match(r"^[\w.-]+=.", pipe):
+                self.error("argument --pipe must be NAME=COMMAND: %s" % pipe)
+        if args.engine == "library" and (args.timeout or args.stall_timeout):
+            self.error(
+                "argument --engine: library cannot be used with "
+                "--timeout or --stall-timeout"
+            )
+        if args.repository:
+            os.environ["BUP_DIR"] = args.repository
+        # remove this one to avoid ambiguity, but keep track of it
+        # for jobs, which may all use different repositories
         del args.repository
+        args.bup_dir = os.environ["BUP_DIR"]
         if args.pidfile is None:
             args.pidfile = os.path.join(os.environ["BUP_DIR"], self.pidfile)
+        if args.stats_db_path is None:
+            args.stats_db_path = os.path.join(
+                os.environ["BUP_DIR"], StatsDatabase.filename
+            )
+        # the database is fed from the same measurements
+        args.stats |= bool(args.stats_db)
         # repair implies check
         args.check |= args.repair
         return args
@@ -328,6 +877,9 @@ class Snapshot(object):
     """default location the snapshot is mounted on"""
     mountpattern = "/media/bup/%s-%s"
 
+    """registry of snapshot backends, name to class, see register()"""
+    backends = {}
+
     def __init__(
         self,
         path,
@@ -352,6 +904,8 @@ class Snapshot(object):
         self.call = call
         # if the snapshot has been created
         self.exists = False
+        # if the snapshot went bad while in use
+        self.invalid = False
         if mountpattern is not None:
             self.mountpattern = mountpattern
 
@@ -376,15 +930,84 @@ class Snapshot(object):
         """this function should undo all that __enter__() did"""
         pass
 
+    def metrics(self):
+        """measurements about the snapshot, for --stats"""
+        return {}
+
+    def check(self):
+        """update self.invalid now, for snapshots that are watched in
+        the background"""
+        pass
+
+    @classmethod
+    def register(cls, name):
+        """class decorator registering a backend for --snapshot NAME"""
+
+        def decorator(backend):
+            cls.backends[name.upper()] = backend
+            for method in ("__enter__", "cleanup"):
+                if method in vars(backend):
+                    phase = "snapshot" if method == "__enter__" else "snapshot-cleanup"
+                    setattr(backend, method, profiled(phase)(vars(backend)[method]))
+            return backend
+
+        return decorator
+
     @staticmethod
     def select(name):
         """Returns the class who handles name"""
-        for cls in Snapshot.__subclasses__():
-            if name.lower() in cls.__name__.lower():
-                return cls
-        raise TypeError("Unknown type: %s" % name)
+        try:
+            return Snapshot.backends[name.upper()]
+        except KeyError:
+            raise TypeError("Unknown type: %s" % name)
+
+    def find_mountpoint(self):
+        path = os.path.realpath(self.path)
+        while not os.path.ismount(path):
+            dirname = os.path.dirname(path)
+            if dirname == path:
+                return None
+            path = dirname
+        return path
+
+    @staticmethod
+    def mounts():
+        """list the (device, mountpoint, fstype) of mounted filesystems
+
+        this reads /proc/self/mounts when available, to avoid spawning
+        mount(8)"""
+        try:
+            with open("/proc/self/mounts") as f:
+                lines = f.read().splitlines()
+        except IOError:
+            output = subprocess.check_output(["mount"]).decode()
+            return re.findall(r"^(.*) on (.*) type (\S+)", output, re.MULTILINE)
+        mounts = []
+        for line in lines:
+            fields = line.split()
+            # spaces and such are escaped as octal sequences
+            fields = [
+                re.sub(r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), f)
+                for f in fields[:3]
+            ]
+            mounts.append(tuple(fields))
+        return mounts
+
+    def find_device(self, mountpoint):
+        """find device based on mountpoint path
+
+        returns the device or False if none found, the filesystem type
+        is kept in self.fstype"""
+        found = False
+        for device, path, fstype in self.mounts():
+            # the last mount on a path hides the previous ones
+            if path == mountpoint and device.startswith("/"):
+                found = device
+                self.fstype = fstype
+        return found
 
 
+@Snapshot.register("NO")
 class NoSnapshot(Snapshot):
     """special class to skip snapshotting
 
@@ -393,7 +1016,51 @@ class NoSnapshot(Snapshot):
     pass
 
 
+@Snapshot.register("LVM")
 class LvmSnapshot(Snapshot):
+    """extra mount options needed to mount a snapshot of a live
+    filesystem read-only: journals can't be replayed on a read-only
+    device, and XFS refuses duplicate filesystem UUIDs"""
+
+    mount_options = {
+        "ext3": ["noload"],
+        "ext4": ["noload"],
+        "xfs": ["nouuid", "norecovery"],
+    }
+
+    fstype = None
+
+    """if the snapshot has its own copy-on-write space, which is
+    watched while it exists and extended by half its size once
+    extend_threshold percents of it are used"""
+    cow = True
+    extend_threshold = 80.0
+    poll_interval = 10.0
+    """margin applied to the estimated size, and the smallest size
+    --size auto will pick, in bytes"""
+    size_margin = 2.0
+    min_size = 64 << 20
+
+    monitor = None
+    created = None
+
+    def create_cmd(self, device):
+        """the command creating the snapshot of device"""
+        size = self.size
+        if size.lower() == "auto":
+            size = self.auto_size(device)
+        return [
+            "lvcreate",
+            "--size",
+            size,
+            "--snapshot",
+            "--permission",
+            "r",
+            "--name",
+            self.snapname(),
+            device,
+        ]
+
     def __enter__(self):
         """set the LVM and mount it"""
         self.vg_lv = None
@@ -403,94 +1070,232 @@ class LvmSnapshot(Snapshot):
             if device:
                 # vg, lv
                 self.vg_lv = LvmSnapshot.find_vg_lv(device)
-            if device and self.vg_lv:
+            if device and self.vg_lv and self.check_origin():
                 # forced cleanup
                 self.cleanup(True)
-                cmd = [
-                    "lvcreate",
-                    "--size",
-                    self.size,
-                    "--snapshot",
-                    "--permission",
-                    "r",
-                    "--name",
-                    self.snapname(),
-                    device,
-                ]
+                cmd = self.create_cmd(device)
                 if self.verbose <= 0:
                     cmd += ["--quiet"]
                 if self.verbose >= 3:
                     cmd += ["--verbose"]
-                logging.debug("creating snapshot %s" % self.snapname())
+                logging.debug("creating snapshot %s", self.snapname())
                 if self.call(cmd):
-                    logging.debug(
-                        "making sure mountpoint %s exists" % self.mountpoint()
-                    )
+                    self.created = time.time()
+                    self.extends = 0
+                    if self.cow:
+                        self.start_monitor()
+                    logging.debug("making sure mountpoint %s exists", self.mountpoint())
                     if make_dirs_helper(self.mountpoint()):
-                        logging.debug("mountpoint %s created" % self.mountpoint())
+                        logging.debug("mountpoint %s created", self.mountpoint())
                     self.exists = True
+                    options = ["ro"] + self.mount_options.get(self.fstype, [])
                     if self.call(
-                        ["mount", "-o", "ro", self.device(), self.mountpoint()]
+                        [
+                            "mount",
+                            "-o",
+                            ",".join(options),
+                            self.device(),
+                            self.mountpoint(),
+                        ]
                     ):
                         relpath = os.path.relpath(self.path, mountpoint)
                         self.path = os.path.join(self.mountpoint(), relpath)
                     else:
                         logging.warning(
                             """failed to mount snapshot %s on %s,
-skipping snapshotting"""
-                            % (self.snapname(), self.mountpoint())
+skipping snapshotting""",
+                            self.snapname(),
+                            self.mountpoint(),
                         )
                         self.cleanup()
                 else:
                     logging.warning(
                         """failed to create snapshot %s/%s,
-skipping snapshooting"""
-                        % self.vg_lv
+skipping snapshooting""",
+                        *self.vg_lv,
                     )
             else:
                 # XXX: we could try to find the parent mountpoint...
                 # see https://github.com/pfrouleau/bup/commit/1244a2da0bf480591b19b9b6123a51ab8662ab56
                 logging.warning(
-                    "%s is not a LVM mountpoint, skipping snapshotting" % self.path
+                    "%s is not a LVM mountpoint, skipping snapshotting", self.path
                 )
         else:
             logging.warning(
-                "Could not find mountpoint for %s, skipping snapshotting" % self.path
+                "Could not find mountpoint for %s, skipping snapshotting", self.path
             )
         return self
 
-    def find_mountpoint(self):
-        path = os.path.realpath(self.path)
-        while not os.path.ismount(path):
-            dirname = os.path.dirname(path)
-            if dirname == path:
-                return None
-            path = dirname
-        return path
+    def check_origin(self):
+        """hook for subclasses to refuse some origin volumes"""
+        return True
 
-    def find_device(self, mountpoint):
-        """find device based on mountpoint path
+    def state_path(self):
+        return os.path.join(cache_dir(), "lvm-snapshots.json")
+
+    @staticmethod
+    def sectors_written(device):
+        """sectors written to device since boot, from the kernel block
+        statistics, or None if they are unavailable"""
+        name = os.path.basename(os.path.realpath(device))
+        try:
+            with open("/sys/class/block/%s/stat" % name) as f:
+                return int(f.read().split()[6])
+        except (IOError, IndexError, ValueError):
+            return None
+
+    def auto_size(self, device):
+        """estimate the copy-on-write space the snapshot will need
+
+        this is the write rate of the origin, measured between the
+        previous run and now, times the longest recent lifetime of the
+        snapshot, with a margin. it is never less than the largest
+        recent usage either, and the monitor extends the snapshot if
+        this still falls short. without history yet, this is the
+        default size."""
+        state = load_state(self.state_path())
+        key = "%s/%s" % self.vg_lv
+        volume = state.setdefault(key, {})
+        now = time.time()
+        sectors = self.sectors_written(device)
+        last = volume.get("sectors")
+        # counters restart from zero on reboot
+        if sectors is not None and last is not None and sectors >= last:
+            elapsed = now - volume["time"]
+            if elapsed > 0:
+                rate = (sectors - last) * 512 / elapsed
+                volume["rates"] = (volume.get("rates", []) + [rate])[-5:]
+        if sectors is not None:
+            volume["sectors"] = sectors
+            volume["time"] = now
+        save_state(self.state_path(), state)
+
+        rates = volume.get("rates")
+        lifetimes = volume.get("lifetimes")
+        if not rates or not lifetimes:
+            logging.info("no history for %s yet, using %s snapshot", key, Snapshot.size)
+            return Snapshot.size
+        size = max(rates) * max(lifetimes) * self.size_margin
+        size = max(
+            size, max(volume.get("peaks", [0])) * self.size_margin, self.min_size
+        )
+        logging.info(
+            "snapshot of %s sized to %dMB: %.1fMB/s for up to %ds",
+            key,
+            size / 2**20,
+            max(rates) / 2**20,
+            max(lifetimes),
+        )
+        return "%dm" % -(-size // 2**20)
 
-        returns the device or False if none found"""
+    def usage(self):
+        """(percent, bytes) of the copy-on-write space used, or None"""
+        import json
 
-        mounts = subprocess.check_output(["mount"])
+        lv = "%s/%s" % (self.vg_lv[0], self.snapname())
         try:
-            return re.match(
-                r".*^(/[^ ]*) on %s .*" % mountpoint, mounts, re.MULTILINE | re.DOTALL
-            ).group(1)
-        except:  # noqa
-            return False
+            output = subprocess.check_output(
+                [
+                    "lvs",
+                    "--reportformat",
+                    "json",
+                    "--units",
+                    "b",
+                    "--nosuffix",
+                    "-o",
+                    "data_percent,lv_size",
+                    lv,
+                ],
+                close_fds=True,
+                stderr=subprocess.DEVNULL,
+            )
+            report = json.loads(output)["report"][0]["lv"][0]
+            percent = float(report["data_percent"])
+            return percent, percent / 100 * int(report["lv_size"])
+        except (OSError, subprocess.CalledProcessError, LookupError, ValueError):
+            return None
+
+    def start_monitor(self):
+        import threading
+
+        self.peak = 0
+        self.stopping = threading.Event()
+        self.monitor = threading.Thread(target=self.watch, daemon=True)
+        self.monitor.start()
+
+    def watch(self):
+        """poll the snapshot usage and extend it before it overflows
+
+        an overflowing snapshot is dropped by LVM, which makes the
+        files under the mountpoint unreadable halfway through the save"""
+        lv = "%s/%s" % (self.vg_lv[0], self.snapname())
+        while not self.stopping.wait(self.poll_interval):
+            usage = self.usage()
+            if usage is None:
+                continue
+            percent, used = usage
+            self.peak = max(self.peak, used)
+            if percent >= 100:
+                logging.error("snapshot %s overflowed, the backup is unreliable", lv)
+                self.invalid = True
+                return
+            if percent >= self.extend_threshold:
+                logging.warning("snapshot %s is %.1f%% full, extending it", lv, percent)
+                if self.call(["lvextend", "--quiet", "--extents", "+50%LV", lv]):
+                    self.extends += 1
+
+    def check(self):
+        # the monitor may not have polled since the save ended
+        if self.monitor is None:
+            return
+        usage = self.usage()
+        if usage is not None and usage[0] >= 100:
+            self.invalid = True
+
+    def stop_monitor(self):
+        """stop the monitor and remember how the snapshot was used"""
+        if self.monitor is None:
+            return
+        self.stopping.set()
+        self.monitor.join()
+        self.monitor = None
+        # copy-on-write usage only grows, the last value is the peak
+        usage = self.usage()
+        if usage is not None:
+            self.peak = max(self.peak, usage[1])
+            if usage[0] >= 100:
+                self.invalid = True
+        state = load_state(self.state_path())
+        volume = state.setdefault("%s/%s" % self.vg_lv, {})
+        lifetime = time.time() - self.created
+        volume["lifetimes"] = (volume.get("lifetimes", []) + [lifetime])[-5:]
+        volume["peaks"] = (volume.get("peaks", []) + [self.peak])[-5:]
+        save_state(self.state_path(), state)
+
+    def metrics(self):
+        if self.monitor is None:
+            return {}
+        usage = self.usage()
+        if usage is not None:
+            self.peak = max(self.peak, usage[1])
+        return {"snapshot_peak_bytes": self.peak, "snapshot_extends": self.extends}
 
     @staticmethod
     def find_vg_lv(device):
         """find the volume group and logical volume of the specified device"""
         try:
-            lvs = subprocess.check_output(["lvs", device], close_fds=True)
-        except subprocess.CalledProcessError:
+            lvs = subprocess.check_output(
+                ["lvs", "--noheadings", "-o", "vg_name,lv_name", device],
+                close_fds=True,
+                stderr=subprocess.DEVNULL,
+            )
+        except (OSError, subprocess.CalledProcessError):
             # not a LVM
             return False
-        # second line of output, second and third fields, backwards
-        return tuple(re.split(r" +", re.split("\n", lvs)[1])[2:0:-1])
+        fields = lvs.decode().split()
+        if len(fields) != 2:
+            return False
+        return tuple(fields)
 
     def snapname(self):
         """the name of the snapshot volume to be created
@@ -512,6 +1317,7 @@ skipping snapshooting"""
         if not self.exists and not force:
             return
         self.exists = False
+        self.stop_monitor()
         m = self.mountpoint()
         # wait for bup to finish
         try:
@@ -522,10 +1328,10 @@ skipping snapshooting"""
             else:
                 raise
         if os.path.ismount(m):
-            logging.debug("umounting %s" % m)
+            logging.debug("umounting %s", m)
             if not self.call(["umount", m]):
-                logging.warning("failed to umount %s" % m)
-        logging.debug("removing directory %s" % m)
+                logging.warning("failed to umount %s", m)
+        logging.debug("removing directory %s", m)
         try:
             os.removedirs(m)
         except:  # noqa
@@ -538,17 +1344,142 @@ skipping snapshooting"""
                 cmd += ["--quiet"]
             if self.verbose >= 3:
                 cmd += ["--verbose"]
+            import stat
+
             if stat.S_ISBLK(os.stat(device).st_mode):
-                logging.debug("dropping snapshot %s" % device)
+                logging.debug("dropping snapshot %s", device)
                 if not self.call(cmd):
-                    logging.warning("failed to drop snapshot %s" % device)
+                    logging.warning("failed to drop snapshot %s", device)
         except OSError:
             # normal: the device doesn't exist, moving on
             return
 
 
+@Snapshot.register("LVMTHIN")
+class ThinLvmSnapshot(LvmSnapshot):
+    """thin LVM snapshots
+
+    those are created instantly, without copy-on-write space to
+    reserve and without degrading the write performance of the origin,
+    but the origin must be a thin volume"""
+
+    cow = False
+
+    def check_origin(self):
+        try:
+            pool = subprocess.check_output(
+                ["lvs", "--noheadings", "-o", "pool_lv", "%s/%s" % self.vg_lv],
+                close_fds=True,
+            )
+        except (OSError, subprocess.CalledProcessError):
+            pool = b""
+        if not pool.strip():
+            logging.warning(
+                "%s/%s is not a thin volume, skipping snapshotting", *self.vg_lv
+            )
+            return False
+        return True
+
+    def create_cmd(self, device):
+        # thin snapshots are not activated by default
+        return [
+            "lvcreate",
+            "--snapshot",
+            "--setactivationskip",
+            "n",
+            "--permission",
+            "r",
+            "--name",
+            self.snapname(),
+            "%s/%s" % self.vg_lv,
+        ]
+
+
+@Snapshot.register("FREEZE")
+class FreezeSnapshot(Snapshot):
+    """freeze the filesystem with fsfreeze(8) during the backup
+
+    this gives a consistent view of filesystems without LVM, at the
+    cost of blocking all writes to it until the backup is done. the
+    frozen filesystem is bind-mounted read-only on the mountpoint,
+    named after the "freeze" and the basename of the filesystem.
+
+    the repository, the log file, the cache and temporary directories
+    or the root filesystem can never be frozen, as that would block
+    bup-cron itself."""
+
+    frozen = None
+    """other paths bup-cron writes to during the run, see process()"""
+    needed = []
+
+    def __enter__(self):
+        mountpoint = self.find_mountpoint()
+        if mountpoint is None:
+            logging.warning(
+                "Could not find mountpoint for %s, skipping snapshotting", self.path
+            )
+            return self
+        import tempfile
+
+        blocked = ["/", sys.executable, os.environ.get("BUP_DIR", "/")]
+        blocked += [cache_dir(), tempfile.gettempdir()] + self.needed
+        if global_logger and global_logger.logfile:
+            blocked.append(global_logger.logfile)
+        for path in blocked:
+            if self.covers(mountpoint, path):
+                logging.warning(
+                    "refusing to freeze %s, bup-cron needs %s, skipping snapshotting",
+                    mountpoint,
+                    path,
+                )
+                return self
+        self.name = ("freeze", os.path.basename(mountpoint))
+        target = self.mountpattern % self.name
+        make_dirs_helper(target)
+        if not self.call(["mount", "--bind", "-o", "ro", mountpoint, target]):
+            logging.warning("failed to bind-mount %s, skipping snapshotting", target)
+            return self
+        self.exists = True
+        # some kernels ignore ro on the initial bind mount
+        self.call(["mount", "-o", "remount,bind,ro", target])
+        logging.debug("freezing %s", mountpoint)
+        if not self.call(["fsfreeze", "--freeze", mountpoint]):
+            logging.warning("failed to freeze %s, skipping snapshotting", mountpoint)
+            self.cleanup()
+            return self
+        self.frozen = mountpoint
+        self.path = os.path.join(target, os.path.relpath(self.path, mountpoint))
+        return self
+
+    @staticmethod
+    def covers(mountpoint, path):
+        """if path is on the filesystem mounted on mountpoint"""
+        path = os.path.realpath(path)
+        while not os.path.ismount(path):
+            path = os.path.dirname(path)
+        return path == mountpoint
+
+    def cleanup(self, force=False):
+        if self.frozen:
+            logging.debug("thawing %s", self.frozen)
+            if not self.call(["fsfreeze", "--unfreeze", self.frozen]):
+                logging.error("failed to thaw %s, do it by hand!", self.frozen)
+            self.frozen = None
+        if self.exists:
+            target = self.mountpattern % self.name
+            if not self.call(["umount", target]):
+                logging.warning("failed to umount %s", target)
+            else:
+                try:
+                    os.removedirs(target)
+                except OSError:
+                    pass
+            self.exists = False
+
+
 if sys.platform.startswith("cygwin"):
 
+    @Snapshot.register("VSS")
     class VssSnapshot(Snapshot):
         """Handle VSS snapshot, under Cygwin"""
 
@@ -563,23 +1494,23 @@ if sys.platform.startswith("cygwin"):
                 self.mount(fs_root)
             else:
                 logging.warning(
-                    """failed to create snapshot for %s, skipping snapshotting"""
-                    % self.path
+                    """failed to create snapshot for %s, skipping snapshotting""",
+                    self.path,
                 )
             return self
 
         def cleanup(self, force=False):
             if self.shadow_id is not None:
                 device = self._convert2dos(self.src_path)
-                logging.debug("dropping snapshot on %s" % device)
+                logging.debug("dropping snapshot on %s", device)
                 if self.call(["vshadow", "-ds=%s" % self.shadow_id]):
                     self.shadow_id = None
                     self.exits = False
                 else:
-                    logging.warning("failed to drop snapshot %s" % device)
+                    logging.warning("failed to drop snapshot %s", device)
             if os.path.exists(self.mountpattern):
                 self._fail_if_mounted()
-                logging.debug("removing directory %s" % self.mountpattern)
+                logging.debug("removing directory %s", self.mountpattern)
                 os.rmdir(self.mountpattern)
 
         def _convert_path(self, path, spec):
@@ -594,18 +1525,18 @@ if sys.platform.startswith("cygwin"):
         def create_snapshot(self, device):
             self.cleanup(True)
             try:
-                logging.debug("creating snapshot on %s" % device)
+                logging.debug("creating snapshot on %s", device)
                 # Note: Windows XP does not supports permanent shadows (-p)
                 output = subprocess.check_output(["vshadow", "-p", device])
                 # * SNAPSHOT ID = {5a698842-f325-404a-83e7-6a7fa08760a1}
                 self.shadow_id = re.search(
                     r"\* SNAPSHOT ID = (\{[0-9A-Fa-f-]{36}\})", output
                 ).group(1)
-                logging.debug("shadow copy created: %s" % self.shadow_id)
+                logging.debug("shadow copy created: %s", self.shadow_id)
                 self.exists = True
                 return True
             except Exception as e:
-                logging.warning("vss snapshot failed, id=%s: %s" % self.shadow_id, e)
+                logging.warning("vss snapshot failed, id=%s: %s", self.shadow_id, e)
                 return False
 
         def _fail_if_mounted(self):
@@ -632,9 +1563,9 @@ if sys.platform.startswith("cygwin"):
 
         def mount(self, fs_root):
             """mountpattern must be a path in linux format"""
-            logging.debug("making sure mountpoint %s exists" % self.mountpattern)
+            logging.debug("making sure mountpoint %s exists", self.mountpattern)
             if make_dirs_helper(self.mountpattern):
-                logging.debug("mountpoint %s created" % self.mountpattern)
+                logging.debug("mountpoint %s created", self.mountpattern)
             winmount = self._convert2dos(self.mountpattern)
             if len(winmount) == 3:  # if it is a drive letter,
                 winmount = winmount[:-1]  # remove the trailing backslash
@@ -642,35 +1573,165 @@ if sys.platform.startswith("cygwin"):
                 self.path = self.path.replace(fs_root, self.mountpattern)
             else:
                 logging.warning(
-                    """failed to mount snapshot %s on %s, skipping snapshotting"""
-                    % (self.shadow_id, self.mountpattern)
+                    """failed to mount snapshot %s on %s, skipping snapshotting""",
+                    self.shadow_id,
+                    self.mountpattern,
                 )
                 self.cleanup(True)
 
 
-class Bup:
-    """helper to call bup's operations
-
-    The methods assume that BUP_DIR is set."""
-
-    @staticmethod
-    def init(remote_rep):
-        logging.info("initializing bup's dir %s" % quote(os.environ["BUP_DIR"]))
-        cmd = ["bup", "init"]
-        if remote_rep:
-            cmd += ["-r", remote_rep]
+class PipeSource(object):
+    """a backup source streaming the output of a command into bup split
+
+    the output is relayed to bup split by bup-cron, with splice(2) when
+    available, so that the data never hits the disk but a failure of
+    the command can still be detected before bup split commits: bup
+    split is killed instead of being given an end of file, and the
+    truncated output is never saved."""
+
+    """size of the chunks relayed between the processes"""
+    chunk = 1 << 20
+
+    def __init__(self, spec):
+        """spec is a NAME=COMMAND string"""
+        self.name, self.command = spec.split("=", 1)
+        self.bytes = 0
+
+    def relay(self, src, dst):
+        """copy from src to dst until end of file, returns bytes copied"""
+        total = 0
+        splice = getattr(os, "splice", None)
+        while True:
+            if splice is not None:
+                try:
+                    n = splice(src, dst, self.chunk)
+                except OSError as e:
+                    if e.errno != errno.EINVAL:
+                        raise
+                    # not supported between those files, copy instead
+                    splice = None
+                    continue
+            else:
+                data = os.read(src, self.chunk)
+                n = len(data)
+                view = memoryview(data)
+                while view:
+                    written = os.write(dst, view)
+                    view = view[written:]
+            if n == 0:
+                return total
+            total += n
+
+    def save(self, branch, remote_rep):
+        """run the command and save its output, returns True on success"""
+        logging.info("saving output of `%s` in %s", self.command, branch)
+        cmd = ["bup", "split", "-n", branch]
+        if global_logger.verbose <= 0:
+            cmd += ["--quiet"]
+        elif global_logger.verbose >= 3:
+            cmd += ["--verbose"]
+        if remote_rep:
+            cmd += ["-r", remote_rep]
+        logging.debug("calling command `%s`", self.command)
+        source = subprocess.Popen(
+            self.command,
+            shell=True,
+            stdout=subprocess.PIPE,
+            stderr=global_logger._warn,
+            close_fds=True,
+        )
+        logging.debug("calling command `%s`", " ".join(cmd))
+        split = subprocess.Popen(
+            cmd,
+            stdin=subprocess.PIPE,
+            stdout=global_logger._log
+            if global_logger.verbose >= 2
+            else subprocess.DEVNULL,
+            stderr=global_logger._warn,
+            close_fds=True,
+        )
+        killed = False
+        try:
+            self.bytes = self.relay(source.stdout.fileno(), split.stdin.fileno())
+        except OSError as e:
+            # bup split went away, make sure the command does too
+            logging.warning("failed to stream to bup split: %s", e)
+            source.kill()
+            killed = True
+        source.stdout.close()
+        if source.wait() != 0 and not killed:
+            logging.warning(
+                "command `%s` failed with status %d, not saving its output",
+                self.command,
+                source.returncode,
+            )
+            split.kill()
+            split.wait()
+            return False
+        try:
+            split.stdin.close()
+        except OSError:
+            pass
+        if split.wait() != 0:
+            logging.warning("bup split failed with status %d", split.returncode)
+            return False
+        # the output of the command was cut short
+        return not killed
+
+
+class Bup:
+    """helper to call bup's operations
+
+    The methods assume that BUP_DIR is set."""
+
+    """BupLibrary running index and save in-process, see --engine"""
+    library = None
+    """command prefix running bup save and fsck in a cgroup, see PageCache"""
+    scope = []
+
+    @staticmethod
+    def call(cmd):
+        """run a bup command, in-process if the library engine handles it"""
+        if Bup.library is not None and Bup.library.handles(cmd):
+            return Bup.library.call(cmd)
+        if cmd[1] == "save":
+            cmd = Bup.scope + cmd
         return global_logger.check_call(cmd)
 
     @staticmethod
-    def clear_index():
-        logging.info("clearing the index")
-        return global_logger.check_call(["bup", "index", "--clear"])
+    @profiled("bup-init")
+    def init(remote_rep):
+        logging.info("initializing bup's dir %s", quote(os.environ["BUP_DIR"]))
+        cmd = ["bup", "init"]
+        if remote_rep:
+            cmd += ["-r", remote_rep]
+        return global_logger.check_call(cmd)
+
+    @staticmethod
+    @profiled("bup-clear-index")
+    def clear_index(indexfile=None):
+        cmd = ["bup", "index", "--clear"]
+        if indexfile:
+            logging.info("clearing the index %s", quote(indexfile))
+            cmd += ["--indexfile", indexfile]
+        else:
+            logging.info("clearing the index")
+        return global_logger.check_call(cmd)
+
+    @staticmethod
+    def shard(path):
+        """the index file of path with --index-shards, created on demand"""
+        directory = os.path.join(os.environ["BUP_DIR"], "bupindex.d")
+        make_dirs_helper(directory)
+        return os.path.join(directory, os.path.abspath(path).replace("/", "_"))
 
     @staticmethod
+    @profiled("bup-fsck")
     def fsck(remote_rep, parity=False, repair=False):
-        base_cmd = ["bup", "fsck"]
+        base_cmd = Bup.scope + ["bup", "fsck"]
         if remote_rep:
             # XXX: maybe bup-fsck could learn to work on remote repository
+            # --memory-high does not apply on the server
             addr, path = remote_rep.split(":")
             base_cmd = ["ssh", addr, "bup", "-d", path, "fsck"]
 
@@ -696,38 +1757,135 @@ class Bup:
         return global_logger.check_call(cmd)
 
     @staticmethod
+    @profiled("bup-rm")
+    def rm(remote_rep, saves):
+        """remove the given saves (branch/save-name) from the repository
+
+        save names are expected in UTC, see Retention"""
+        logging.info("removing %d saves", len(saves))
+        cmd = ["bup", "rm", "--unsafe"]
+        if global_logger.verbose >= 3:
+            cmd += ["--verbose"]
+        return global_logger.check_call(
+            repository_command(remote_rep, cmd + saves, {"TZ": "UTC"}),
+            env={"TZ": "UTC"},
+        )
+
+    @staticmethod
+    @profiled("bup-gc")
+    def gc(remote_rep):
+        logging.info("collecting garbage in the repository")
+        cmd = ["bup", "gc", "--unsafe"]
+        if global_logger.verbose >= 3:
+            cmd += ["--verbose"]
+        return global_logger.check_call(repository_command(remote_rep, cmd))
+
+    @staticmethod
+    @profiled("bup-index")
     def index(
-        path, excludes, excludes_rx, excludes_from, excludes_rx_from, one_file_system
+        path,
+        excludes,
+        excludes_rx,
+        excludes_from,
+        excludes_rx_from,
+        one_file_system,
+        indexfile=None,
     ):
-        logging.info("indexing %s" % quote(path))
+        logging.info("indexing %s", quote(path))
         # XXX: should be -q(uiet) unless verbose > 0 - but bup
         # index has no -q
         cmd = ["bup", "index"]
         if global_logger.verbose >= 3:
             cmd += ["--verbose"]
-        if excludes:
+        with contextlib.ExitStack() as stack:
+            excludes = excludes or []
+            excludes_rx = excludes_rx or []
+            size = sum(len(ex) + 16 for ex in excludes + excludes_rx)
+            if size > Bup.spill_size:
+                # large exclude sets overflow the maximum size of the
+                # command line (E2BIG), write them to files instead
+                if excludes:
+                    excludes_from = (excludes_from or []) + [Bup.spill(stack, excludes)]
+                if excludes_rx:
+                    excludes_rx_from = (excludes_rx_from or []) + [
+                        Bup.spill(stack, excludes_rx)
+                    ]
+                excludes = excludes_rx = []
             cmd += map((lambda ex: "--exclude=" + ex), excludes)
-        if excludes_rx:
             cmd += map((lambda ex: "--exclude-rx=" + ex), excludes_rx)
-        if excludes_from:
-            cmd += map((lambda ex: "--exclude-from=" + ex), excludes_from)
-        if excludes_rx_from:
-            cmd += map((lambda ex: "--exclude-rx-from=" + ex), excludes_rx_from)
-        if one_file_system:
-            cmd += ["--one-file-system"]
-        cmd += [path]
-        return global_logger.check_call(cmd)
+            if excludes_from:
+                cmd += map((lambda ex: "--exclude-from=" + ex), excludes_from)
+            if excludes_rx_from:
+                cmd += map((lambda ex: "--exclude-rx-from=" + ex), excludes_rx_from)
+            if one_file_system:
+                cmd += ["--one-file-system"]
+            if indexfile:
+                cmd += ["--indexfile", indexfile]
+            cmd += [path]
+            return Bup.call(cmd)
+
+    @staticmethod
+    def modified(path, indexfile=None):
+        """the regular files bup index found modified under path, as
+        (path, stat) tuples, or None if bup index failed"""
+        import stat
+
+        cmd = ["bup", "index", "--modified"]
+        if indexfile:
+            cmd += ["--indexfile", indexfile]
+        try:
+            output = subprocess.check_output(cmd + [path], close_fds=True)
+        except (OSError, subprocess.CalledProcessError):
+            return None
+        files = []
+        for line in output.splitlines():
+            name = os.fsdecode(line)
+            try:
+                st = os.lstat(name)
+            except OSError:
+                continue
+            if stat.S_ISREG(st.st_mode):
+                files.append((name, st))
+        return files
+
+    """size in bytes of --exclude and --exclude-rx arguments above which
+    they are passed through temporary files"""
+    spill_size = 64 << 10
 
     @staticmethod
-    def save(paths, branch, graft, remote_rep):
-        logging.info("saving %s" % quotes(paths))
+    def spill(stack, lines):
+        """write lines to a temporary file removed when stack closes"""
+        import tempfile
+
+        f = stack.enter_context(
+            tempfile.NamedTemporaryFile("w", prefix="bup-cron-", suffix=".exclude")
+        )
+        for line in lines:
+            f.write(line + "\n")
+        f.flush()
+        return f.name
+
+    @staticmethod
+    @profiled("bup-save")
+    def save(
+        paths, branch, graft, remote_rep, compress=None, indexfile=None, report=None
+    ):
+        """save paths, feeding the progress output of bup to report, a
+        SaveReport, unless bup runs in-process"""
+        logging.info("saving %s", quotes(paths))
         cmd = ["bup", "save"]
-        if global_logger.verbose <= 0:
+        if Bup.library is not None and Bup.library.handles(cmd):
+            report = None
+        if global_logger.verbose <= 0 and report is None:
             cmd += ["--quiet"]
         elif global_logger.verbose >= 3:
             cmd += ["--verbose"]
         if remote_rep:
             cmd += ["-r", remote_rep]
+        if compress is not None:
+            cmd += ["--compress=%d" % compress]
+        if indexfile:
+            cmd += ["--indexfile", indexfile]
         cmd += ["--name", branch]
         if "=" in graft:
             cmd += ["--graft", graft]
@@ -738,7 +1896,1518 @@ class Bup:
         if global_logger.verbose >= 2:
             cmd += ["--tree", "--commit"]
         cmd += paths
-        return global_logger.check_call(cmd)
+        if report is not None:
+            return global_logger.check_call(Bup.scope + cmd, output=report.feed)
+        return Bup.call(cmd)
+
+
+class SaveReport(object):
+    """account for what bup save did, from its progress output
+
+    bup save only reports progress to a terminal, see
+    GlobalLogger.check_call, and ends with a line like:
+
+        Saving: 100.00% (2048/2048k, 3/3 files), done.
+
+    where the second number is the size of the files it had to read,
+    and the last one the number of files in the index. the repository
+    growth comes from the caller, as bup does not report it."""
+
+    summary = re.compile(r"^Saving: .*\(\d+/(\d+)k, \d+/(\d+) files\)")
+    """output lines that are progress, not warnings"""
+    progress = re.compile(
+        r"^(Reading index|Saving|Receiving index from server|bloom|midx)\b"
+    )
+
+    def __init__(self):
+        self.scanned = self.files = None
+
+    def feed(self, line):
+        """handle a line bup save wrote on its standard error"""
+        match = self.summary.match(line)
+        if match:
+            self.scanned = int(match.group(1)) * 1024
+            self.files = int(match.group(2))
+        if not self.progress.match(line):
+            global_logger._warn.write(line + "\n")
+        elif "done" in line:
+            logging.debug("%s", line.strip())
+
+    def metrics(self, written, seconds):
+        """log and return the metrics of the save, written is the growth
+        of the repository, or None if unknown"""
+        if self.scanned is None:
+            return {}
+        format_bytes = BupCronMetaData.format_bytes
+        metrics = {"save_scanned_bytes": self.scanned, "save_files": self.files}
+        if seconds > 0:
+            metrics["save_mbps"] = self.scanned / seconds / 1e6
+        if written is not None:
+            metrics["save_written_bytes"] = written
+            if written > 0:
+                metrics["dedup_ratio"] = self.scanned / written
+        logging.info(
+            "read %s in %d files at %.1f MB/s, wrote %s",
+            format_bytes(self.scanned),
+            self.files,
+            metrics.get("save_mbps", 0),
+            "unknown" if written is None else format_bytes(written),
+        )
+        return metrics
+
+
+class ExcludeScanner(object):
+    """find the caches and nodump files of a path before indexing it
+
+    the tree is walked with os.scandir, without descending in excluded
+    directories, other filesystems, or --exclude paths, and what was
+    found is written to a file passed to bup index with --exclude-from.
+
+    what each directory holds is cached, with its mtime and ctime: the
+    entries of a directory whose times did not change are not read
+    again, only its subdirectories are visited. setting the nodump
+    attribute of a file does not change its directory, so the cache is
+    dropped after max_age seconds"""
+
+    signature = b"Signature: 8a477f597d28d172789f06886806bc55"
+    FS_IOC_GETFLAGS = 0x80086601
+    FS_NODUMP_FL = 0x40
+    max_age = 7 * 86400
+
+    def __init__(self, caches, nodump, excludes=None):
+        self.caches = caches
+        self.nodump = nodump
+        self.prune = {os.path.abspath(path) for path in excludes or []}
+        # devices where the attributes cannot be read
+        self.unsupported = set()
+
+    def tagged(self, path):
+        """if path is a valid CACHEDIR.TAG"""
+        try:
+            with open(path, "rb") as f:
+                return f.read(len(self.signature)) == self.signature
+        except OSError:
+            return False
+
+    def no_dump(self, path, dev):
+        """if path has the nodump attribute"""
+        import fcntl
+        import struct
+
+        if dev in self.unsupported:
+            return False
+        try:
+            fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK | os.O_NOFOLLOW)
+        except OSError:
+            return False
+        try:
+            flags = fcntl.ioctl(fd, self.FS_IOC_GETFLAGS, bytes(8))
+        except OSError as e:
+            if e.errno in (errno.ENOTTY, errno.EOPNOTSUPP, errno.EINVAL):
+                self.unsupported.add(dev)
+            return False
+        finally:
+            os.close(fd)
+        return bool(struct.unpack("i", flags[:4])[0] & self.FS_NODUMP_FL)
+
+    def read(self, path, dev):
+        """list a directory: returns if it is excluded itself, its
+        subdirectories and its excluded files"""
+        if self.nodump and self.no_dump(path, dev):
+            return True, [], []
+        subdirs = []
+        files = []
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.name)
+                    elif not entry.is_file(follow_symlinks=False):
+                        continue
+                    elif (
+                        self.caches
+                        and entry.name == "CACHEDIR.TAG"
+                        and self.tagged(entry.path)
+                    ):
+                        return True, [], []
+                    elif self.nodump and self.no_dump(entry.path, dev):
+                        files.append(entry.name)
+        except OSError as e:
+            logging.debug("could not list %s: %s", path, e)
+        return False, subdirs, files
+
+    @profiled("exclude-scan")
+    def scan(self, root, name):
+        """find what to exclude under root, name identifies the cache of
+        the path. returns the exclude file and metrics"""
+        import stat
+
+        base = os.path.join(cache_dir(), "exclude-scan", name.replace("/", "_"))
+        state = load_state(base + ".json")
+        options = [self.caches, self.nodump]
+        if state.get("options") != options or (
+            time.time() - state.get("time", 0) > self.max_age
+        ):
+            state = {"options": options, "time": time.time()}
+        cached = state.get("dirs", {})
+        dirs = {}
+        excluded = []
+        read = 0
+        start = time.monotonic()
+        st = os.lstat(root)
+        dev = st.st_dev
+        todo = [("", st)]
+        while todo:
+            rel, st = todo.pop()
+            path = os.path.join(root, rel) if rel else root
+            stamp = [st.st_mtime_ns, st.st_ctime_ns]
+            entry = cached.get(rel)
+            if entry is None or entry[0] != stamp:
+                entry = [stamp, *self.read(path, dev)]
+                read += 1
+            dirs[rel] = entry
+            _, skip, subdirs, files = entry
+            if skip:
+                excluded.append(path)
+                continue
+            excluded += [os.path.join(path, f) for f in files]
+            for subdir in subdirs:
+                sub = os.path.join(path, subdir)
+                if sub in self.prune:
+                    continue
+                try:
+                    st = os.lstat(sub)
+                except OSError:
+                    continue
+                # bup index is ran with --one-file-system
+                if st.st_dev == dev and stat.S_ISDIR(st.st_mode):
+                    todo.append((os.path.join(rel, subdir), st))
+        state["dirs"] = dirs
+        save_state(base + ".json", state)
+        with open(base + ".exclude", "wb") as f:
+            for path in excluded:
+                if "\n" not in path:
+                    f.write(os.fsencode(path) + b"\n")
+        metrics = {
+            "scan_excluded": len(excluded),
+            "scan_dirs": len(dirs),
+            "scan_dirs_read": read,
+            "scan_seconds": time.monotonic() - start,
+        }
+        logging.info(
+            "found %d caches and nodump files in %s, read %d of %d directories",
+            len(excluded),
+            root,
+            read,
+            len(dirs),
+        )
+        return base + ".exclude", metrics
+
+
+class PageCache(object):
+    """keep the reads of bup from evicting the page cache
+
+    bup save reads every modified file through the page cache, which
+    evicts the working set of other programs, like databases. with
+    systemd, bup save and fsck run in a transient scope with a
+    memory.high limit, where the kernel reclaims their own cache pages
+    first. otherwise, the modified files that were not cached at all
+    before the save are dropped from the cache after it, as are the
+    packs it wrote, with posix_fadvise. files that were cached are left
+    alone, they were in use.
+
+    the Cached line of /proc/meminfo is measured around each save"""
+
+    def __init__(self, memory_high):
+        self.memory_high = memory_high
+        self.scope = self.probe()
+        self.libc = None
+
+    def probe(self):
+        """the systemd-run prefix to run commands with, or [] if it does
+        not work here"""
+        if not os.path.isdir("/run/systemd/system"):
+            return []
+        cmd = ["systemd-run", "--scope", "--quiet", "--collect"]
+        if os.geteuid() != 0:
+            cmd += ["--user"]
+        cmd += ["-p", "MemoryHigh=%s" % self.memory_high, "--"]
+        try:
+            subprocess.check_call(
+                cmd + ["true"],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                close_fds=True,
+            )
+        except (OSError, subprocess.CalledProcessError):
+            logging.info("cannot run commands in a cgroup, dropping caches instead")
+            return []
+        return cmd
+
+    @staticmethod
+    def cached():
+        """bytes in the page cache, or None"""
+        try:
+            with open("/proc/meminfo") as f:
+                for line in f:
+                    if line.startswith("Cached:"):
+                        return int(line.split()[1]) * 1024
+        except (OSError, ValueError, IndexError):
+            pass
+        return None
+
+    def resident(self, path, size):
+        """if any page of path is in the page cache, True if unknown"""
+        import ctypes
+        import mmap
+
+        if self.libc is None:
+            self.libc = ctypes.CDLL(None, use_errno=True)
+            self.libc.mmap.restype = ctypes.c_void_p
+            self.libc.mmap.argtypes = [
+                ctypes.c_void_p,
+                ctypes.c_size_t,
+                ctypes.c_int,
+                ctypes.c_int,
+                ctypes.c_int,
+                ctypes.c_long,
+            ]
+            self.libc.mincore.argtypes = [
+                ctypes.c_void_p,
+                ctypes.c_size_t,
+                ctypes.c_void_p,
+            ]
+            self.libc.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+        try:
+            fd = os.open(path, os.O_RDONLY | os.O_NOFOLLOW | os.O_NONBLOCK)
+        except OSError:
+            return True
+        try:
+            addr = self.libc.mmap(None, size, mmap.PROT_READ, mmap.MAP_SHARED, fd, 0)
+            if addr in (None, ctypes.c_void_p(-1).value):
+                return True
+            try:
+                pages = (size + mmap.PAGESIZE - 1) // mmap.PAGESIZE
+                vec = (ctypes.c_ubyte * pages)()
+                if self.libc.mincore(addr, size, vec) != 0:
+                    return True
+                # the other bits are reserved, count in C
+                return bytes(vec).count(0) != pages
+            finally:
+                self.libc.munmap(addr, size)
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def drop(paths):
+        """drop paths from the page cache, returns how many were dropped"""
+        dropped = 0
+        for path in paths:
+            try:
+                fd = os.open(path, os.O_RDONLY | os.O_NOFOLLOW | os.O_NONBLOCK)
+            except OSError:
+                continue
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+                dropped += 1
+            except OSError:
+                pass
+            finally:
+                os.close(fd)
+        return dropped
+
+    @contextlib.contextmanager
+    def guard(self, path, remote_rep, indexfile=None):
+        """keep the save ran in this block out of the page cache, the
+        metrics dict yielded is filled when it ends"""
+        metrics = {}
+        before = self.cached()
+        cold = []
+        packs = set()
+        directory = os.path.join(os.environ["BUP_DIR"], "objects", "pack")
+        if not self.scope:
+            for name, st in Bup.modified(path, indexfile) or []:
+                if st.st_size and not self.resident(name, st.st_size):
+                    cold.append(name)
+            if not remote_rep and os.path.isdir(directory):
+                packs = set(os.listdir(directory))
+        yield metrics
+        if not self.scope:
+            if not remote_rep and os.path.isdir(directory):
+                cold += [
+                    os.path.join(directory, name)
+                    for name in set(os.listdir(directory)) - packs
+                    if name.endswith(".pack")
+                ]
+            metrics["page_cache_dropped_files"] = self.drop(cold)
+        after = self.cached()
+        if before is not None and after is not None:
+            metrics["page_cache_before"] = before
+            metrics["page_cache_after"] = after
+            format_bytes = BupCronMetaData.format_bytes
+            logging.info(
+                "page cache: %s before the save, %s after",
+                format_bytes(before),
+                format_bytes(after),
+            )
+
+
+class BupLibrary(object):
+    """run bup commands in the bup-cron process, for --engine library
+
+    every bup process starts python and imports bup's modules again,
+    which dominates the time of saving many small paths. this imports
+    the commands of bup 0.32 and later, which have a main(argv) entry
+    point, once, and calls them for index and save. only the imports
+    are shared: each call still opens the index, the pack indexes and
+    their midx and bloom files itself. bup's global error list is
+    emptied before each call, as bup save fails if it holds anything.
+    bup is looked up in sys.path, then next to the bup executable
+    (/usr/lib/bup for /usr/bin/bup)."""
+
+    commands = ("index", "save")
+
+    def __init__(self, fallback=True):
+        self.fallback = fallback
+        self.modules = {}
+        self.helpers = None
+
+    def load(self):
+        """import the bup commands, returns False if they are unusable"""
+        import importlib
+        import shutil
+
+        executable = shutil.which("bup")
+        if executable:
+            libdir = os.path.dirname(os.path.dirname(os.path.realpath(executable)))
+            if os.path.isdir(os.path.join(libdir, "bup")) and libdir not in sys.path:
+                sys.path.append(libdir)
+        try:
+            for name in self.commands:
+                module = importlib.import_module("bup.cmd." + name)
+                if not callable(getattr(module, "main", None)):
+                    raise ImportError("bup.cmd.%s has no main()" % name)
+                self.modules[name] = module
+            self.helpers = importlib.import_module("bup.helpers")
+        except (ImportError, SyntaxError) as e:
+            logging.info("bup library unusable, running bup commands: %s", e)
+            return False
+        logging.debug("running bup %s in-process", " and ".join(self.commands))
+        return True
+
+    def handles(self, cmd):
+        return cmd[0] == "bup" and cmd[1] in self.modules
+
+    def call(self, cmd):
+        """run cmd in-process, falling back to a bup process on crashes"""
+        command = " ".join(cmd)
+        argv = [os.fsencode(arg) for arg in ["bup-" + cmd[1]] + cmd[2:]]
+        logging.debug("calling `%s` in-process", command, extra={"command": command})
+        # the commands import this very list, it must be emptied in place
+        errors = getattr(self.helpers, "saved_errors", None)
+        if errors is not None:
+            del errors[:]
+        start = time.monotonic()
+        try:
+            rc = self.modules[cmd[1]].main(argv) or 0
+        except SystemExit as e:
+            rc = e.code if isinstance(e.code, int) else int(e.code is not None)
+        except Exception:
+            logging.exception("bup %s crashed in-process", cmd[1])
+            rc = None
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        duration = time.monotonic() - start
+        if profiler is not None:
+            profiler.child(cmd, duration)
+        fields = {"command": command, "duration": duration, "rc": rc}
+        if rc == 0:
+            logging.debug("command done in %.3f seconds", duration, extra=fields)
+            return True
+        if rc is None and self.fallback:
+            logging.warning("retrying bup %s in a separate process", cmd[1])
+            return global_logger.check_call(cmd)
+        logging.warning("command failed with status %s", rc, extra=fields)
+        return False
+
+
+class CompressionTuner(object):
+    """pick the compression level of bup save for a repository
+
+    the CPU time of the saves is compared to their wall time: a save
+    mostly waiting on the network or disks can afford to compress
+    more, which sends less data, while a save spending most of its
+    time on the CPU is slowed down by compression. the level moves by
+    one step per run, and is kept per repository in the cache
+    directory, as links to different repositories behave differently"""
+
+    """CPU to wall time ratios under and over which the level changes"""
+    low = 0.5
+    high = 0.85
+    """level to start from, bup's default"""
+    initial = 1
+
+    def __init__(self, remote_rep):
+        self.key = remote_rep or os.path.realpath(os.environ["BUP_DIR"])
+        self.path = os.path.join(cache_dir(), "compression.json")
+        state = load_state(self.path).get(self.key, {})
+        self.level = state.get("level", self.initial)
+        self.cpu = self.wall = 0.0
+
+    @contextlib.contextmanager
+    def measure(self):
+        """account the child processes ran in this block"""
+        before = os.times()
+        yield
+        after = os.times()
+        self.cpu += (after[2] + after[3]) - (before[2] + before[3])
+        self.wall += after[4] - before[4]
+
+    def ratio(self):
+        return self.cpu / self.wall if self.wall > 0 else None
+
+    def update(self):
+        """pick the level of the next run and remember it"""
+        ratio = self.ratio()
+        if ratio is None:
+            return
+        level = self.level
+        if ratio < self.low:
+            level = min(level + 1, 9)
+        elif ratio > self.high:
+            level = max(level - 1, 0)
+        logging.info(
+            "saves used %d%% CPU at compression level %d, next level: %d",
+            ratio * 100,
+            self.level,
+            level,
+        )
+        state = load_state(self.path)
+        state[self.key] = {"level": level, "cpu_ratio": ratio}
+        save_state(self.path, state)
+
+
+class Preflight(object):
+    """check that the changes to save fit in the repository
+
+    the size of the files bup index found modified, times the ratio of
+    repository growth to modified bytes seen in previous runs of the
+    branch, is compared to the free space of the repository
+    filesystem, queried once per run. paths that would not fit are
+    skipped before bup save writes anything, which would otherwise
+    fill the disk and leave partial packs behind, and the other paths
+    still get their chance."""
+
+    """the estimate is multiplied by margin, and reserve bytes are
+    always kept free"""
+    margin = 1.1
+    reserve = 64 << 20
+    """runs modifying less than learn_size bytes do not change the
+    ratio, which is never more than max_ratio"""
+    learn_size = 1 << 20
+    max_ratio = 1.5
+
+    def __init__(self, remote_rep):
+        self.remote = remote_rep
+        self.key = remote_rep or os.path.realpath(os.environ["BUP_DIR"])
+        self.path = os.path.join(cache_dir(), "preflight.json")
+        self.free = self.free_space()
+        self.predicted = {}
+
+    def free_space(self):
+        """bytes available on the repository filesystem, or None"""
+        try:
+            if not self.remote:
+                st = os.statvfs(os.environ["BUP_DIR"])
+                return st.f_bavail * st.f_frsize
+            import shlex
+
+            server, path = self.remote.split(":", 1)
+            output = subprocess.check_output(
+                ["ssh", "-T", server, "df -P -k " + shlex.quote(path or ".")],
+                close_fds=True,
+            )
+            return int(output.decode().splitlines()[-1].split()[3]) * 1024
+        except (OSError, subprocess.CalledProcessError, IndexError, ValueError) as e:
+            logging.warning("could not find the free space in the repository: %s", e)
+            return None
+
+    @staticmethod
+    def dirty_bytes(path, indexfile=None):
+        """size of the files bup index found modified under path"""
+        files = Bup.modified(path, indexfile)
+        if files is None:
+            return None
+        return sum(st.st_size for _, st in files)
+
+    def ratio(self, branch):
+        """repository growth per modified byte, the worst of the last runs"""
+        ratios = load_state(self.path).get(self.key, {}).get(branch)
+        return max(ratios) if ratios else 1.0
+
+    def check(self, branch, path, indexfile=None):
+        """if the changes in path fit in the repository"""
+        if self.free is None:
+            return True
+        dirty = self.dirty_bytes(path, indexfile)
+        if dirty is None:
+            logging.warning("could not list modified files in %s", path)
+            return True
+        estimate = dirty * self.ratio(branch)
+        self.predicted[branch] = (dirty, estimate)
+        format_bytes = BupCronMetaData.format_bytes
+        if estimate * self.margin + self.reserve > self.free:
+            logging.error(
+                "%s would grow the repository by about %s, but only %s is free",
+                path,
+                format_bytes(estimate),
+                format_bytes(self.free),
+            )
+            return False
+        logging.debug(
+            "%s: %s modified, expecting the repository to grow by %s",
+            path,
+            format_bytes(dirty),
+            format_bytes(estimate),
+        )
+        self.free -= estimate
+        return True
+
+    def record(self, branch, actual):
+        """compare the actual growth to the prediction, and learn from it
+
+        returns the predicted and actual growth as metrics"""
+        if branch not in self.predicted or actual is None:
+            return {}
+        dirty, estimate = self.predicted.pop(branch)
+        format_bytes = BupCronMetaData.format_bytes
+        logging.info(
+            "repository growth of %s: predicted %s, actual %s",
+            branch,
+            format_bytes(estimate),
+            format_bytes(actual),
+        )
+        # small changes are dominated by metadata, and tell nothing
+        # about how well the next large ones will deduplicate
+        if dirty >= self.learn_size:
+            ratio = min(max(actual, 0) / dirty, self.max_ratio)
+            state = load_state(self.path)
+            ratios = state.setdefault(self.key, {}).get(branch, [])
+            state[self.key][branch] = (ratios + [ratio])[-5:]
+            save_state(self.path, state)
+        return {"preflight_predicted_bytes": estimate, "preflight_actual_bytes": actual}
+
+
+class SampleVerifier(object):
+    """verify a save by restoring a random sample of files from it
+
+    files are sampled with a probability proportional to their size,
+    among those bup index recorded under the saved path, so files left
+    out by --exclude and the like are never picked. they are restored
+    in parallel with bup restore into a scratch directory and
+    compared with the source, which should be the snapshot the save was
+    made from. this proves restores work and measures their speed."""
+
+    def __init__(self, count, scratch=None, jobs=4):
+        self.count = count
+        self.scratch = scratch
+        self.jobs = jobs
+
+    def sample(self, root, indexfile=None):
+        """pick files under root, returns a list of (relpath, stat) tuples
+
+        the files are listed from the index, which only holds what bup
+        save was given. this uses weighted reservoir sampling
+        (Efraimidis-Spirakis), so memory use is bounded by the sample
+        size, not the tree size"""
+        import heapq
+        import random
+        import stat
+
+        reservoir = []
+        cmd = ["bup", "index", "--print", "--status"]
+        if indexfile:
+            cmd += ["--indexfile", indexfile]
+        try:
+            index = subprocess.Popen(
+                cmd + [root], stdout=subprocess.PIPE, close_fds=True
+            )
+        except OSError as e:
+            logging.warning("cannot list the index of %s: %s", root, e)
+            return []
+        with index:
+            for line in index.stdout:
+                # a status character and a space, then the path
+                status, name = line[:1], os.fsdecode(line.rstrip(b"\n")[2:])
+                if status == b"D" or name.endswith("/"):
+                    continue
+                relpath = os.path.relpath(name, root)
+                if relpath.startswith(".."):
+                    continue
+                try:
+                    st = os.lstat(name)
+                except OSError:
+                    continue
+                if not stat.S_ISREG(st.st_mode):
+                    continue
+                key = random.random() ** (1.0 / max(st.st_size, 1))
+                item = (key, relpath, st)
+                if len(reservoir) < self.count:
+                    heapq.heappush(reservoir, item)
+                elif key > reservoir[0][0]:
+                    heapq.heapreplace(reservoir, item)
+        if index.returncode != 0:
+            logging.warning("cannot list the index of %s", root)
+        return [(relpath, st) for key, relpath, st in reservoir]
+
+    @staticmethod
+    def digest(path):
+        import hashlib
+
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+        return h.hexdigest()
+
+    def check(self, tmpdir, index, root, branch, remote_rep, relpath, st):
+        """restore one file and compare it, returns True, False or None
+        if the source changed since the save"""
+        target = os.path.join(tmpdir, str(index))
+        os.mkdir(target)
+        cmd = ["bup", "restore", "--quiet", "-C", target]
+        if remote_rep:
+            cmd += ["-r", remote_rep]
+        cmd += ["%s/latest/%s" % (branch, relpath)]
+        if not global_logger.check_call(cmd):
+            logging.warning("failed to restore %s", relpath)
+            return False
+        restored = os.path.join(target, os.path.basename(relpath))
+        source = os.path.join(root, relpath)
+        try:
+            same = self.digest(restored) == self.digest(source)
+            now = os.lstat(source)
+        except OSError as e:
+            logging.warning("cannot compare %s: %s", relpath, e)
+            return False
+        finally:
+            if os.path.exists(restored):
+                os.remove(restored)
+        if (now.st_mtime_ns, now.st_size) != (st.st_mtime_ns, st.st_size):
+            logging.debug("%s changed during the backup, not verified", relpath)
+            return None
+        if not same:
+            logging.warning("restored %s differs from the source", relpath)
+        return same
+
+    @profiled("verify")
+    def verify(self, root, branch, remote_rep, indexfile=None):
+        """verify the last save of branch against root, indexed in
+        indexfile
+
+        returns a dict of measurements, with a "verify_failures" count"""
+        import shutil
+        import tempfile
+        from concurrent.futures import ThreadPoolExecutor
+
+        sample = self.sample(root, indexfile)
+        logging.info("verifying %d files restored from %s", len(sample), branch)
+        tmpdir = tempfile.mkdtemp(prefix="bup-cron-verify-", dir=self.scratch)
+        timer = Timer()
+        try:
+            with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+                results = list(
+                    pool.map(
+                        lambda job: self.check(
+                            tmpdir, job[0], root, branch, remote_rep, *job[1]
+                        ),
+                        enumerate(sample),
+                    )
+                )
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+        seconds = timer.diff().total_seconds()
+        size = sum(st.st_size for (relpath, st), ok in zip(sample, results) if ok)
+        metrics = {
+            "verify_files": results.count(True),
+            "verify_failures": results.count(False),
+            "verify_bytes": size,
+            "restore_mbps": size / seconds / 1e6 if seconds else None,
+        }
+        logging.info(
+            "verified %d files (%s) in %.1f seconds, %d failures",
+            metrics["verify_files"],
+            BupCronMetaData.format_bytes(size),
+            seconds,
+            metrics["verify_failures"],
+        )
+        return metrics
+
+
+class Maintenance(object):
+    """keep object lookups fast as the repository grows
+
+    every save adds packs, and bup save looks up every object it writes
+    in every pack index, unless midx files combine those indexes and a
+    bloom filter rules out most absent objects first. both are updated
+    incrementally: bup midx --auto only merges what needs merging, and
+    bup bloom only adds the new indexes."""
+
+    steps = [["bup", "midx", "--auto"], ["bup", "bloom"]]
+
+    def __init__(self, remote_rep):
+        self.remote = remote_rep
+
+    def counts(self):
+        """count the packs, midx and bloom files of the repository"""
+        if self.remote:
+            import shlex
+
+            server, path = self.remote.split(":", 1)
+            directory = os.path.join(path or ".bup", "objects", "pack")
+            try:
+                names = (
+                    subprocess.check_output(
+                        ["ssh", "-T", server, "ls " + shlex.quote(directory)],
+                        close_fds=True,
+                    )
+                    .decode()
+                    .split()
+                )
+            except (OSError, subprocess.CalledProcessError):
+                return {}
+        else:
+            directory = os.path.join(os.environ["BUP_DIR"], "objects", "pack")
+            try:
+                names = os.listdir(directory)
+            except OSError:
+                return {}
+        return {
+            "packs": sum(1 for n in names if n.endswith(".pack")),
+            "midx": sum(1 for n in names if n.endswith(".midx")),
+            "bloom": sum(1 for n in names if n.endswith(".bloom")),
+        }
+
+    @profiled("maintain")
+    def run(self, budget=None):
+        """run the maintenance steps, within budget seconds if given
+
+        returns the pack, midx and bloom counts before and after, and
+        the time spent, as metrics"""
+        timer = Timer()
+        before = self.counts()
+        for cmd in self.steps:
+            if budget and timer.diff().total_seconds() > budget:
+                logging.warning("maintenance budget exhausted, skipping %s", cmd[1])
+                break
+            logging.info("running %s", " ".join(cmd))
+            if not global_logger.check_call(repository_command(self.remote, cmd)):
+                logging.warning("%s failed", " ".join(cmd))
+        after = self.counts()
+        metrics = {"maintenance_seconds": timer.diff().total_seconds()}
+        for name in before:
+            metrics["%s_before" % name] = before[name]
+            metrics["%s_after" % name] = after.get(name)
+        if before and after:
+            logging.info(
+                "maintenance: packs %d, midx %d -> %d, bloom %d -> %d",
+                after["packs"],
+                before["midx"],
+                after["midx"],
+                before["bloom"],
+                after["bloom"],
+            )
+        return metrics
+
+
+class RotatingVerifier(object):
+    """verify the whole repository, a slice every run
+
+    bup fsck --quick only checks the checksum of packs, while a full
+    check of every object of a large repository takes longer than a
+    backup window. this keeps the time every pack was last fully
+    verified in a state file in the repository, and verifies the
+    oldest ones first, in batches of parallel bup fsck jobs, a total
+    size of a days'th of the repository per run, within a time budget."""
+
+    filename = "bup-cron-verified.json"
+
+    def __init__(self, remote_rep, days, jobs=4):
+        self.remote = remote_rep
+        self.days = days
+        self.jobs = max(jobs, 1)
+        self.key = remote_rep or "local"
+        self.path = os.path.join(os.environ["BUP_DIR"], self.filename)
+
+    def pack_dir(self):
+        if self.remote:
+            path = self.remote.split(":", 1)[1] or ".bup"
+        else:
+            path = os.environ["BUP_DIR"]
+        return os.path.join(path, "objects", "pack")
+
+    def packs(self):
+        """return a dict of pack names to sizes"""
+        directory = self.pack_dir()
+        if not self.remote:
+            return {
+                e.name: e.stat().st_size
+                for e in os.scandir(directory)
+                if e.name.endswith(".pack")
+            }
+        import shlex
+
+        server = self.remote.split(":", 1)[0]
+        cmd = "find %s -maxdepth 1 -name '*.pack' -printf '%%s %%f\\n'" % shlex.quote(
+            directory
+        )
+        output = subprocess.check_output(["ssh", "-T", server, cmd], close_fds=True)
+        packs = {}
+        for line in output.decode().splitlines():
+            size, name = line.split(" ", 1)
+            packs[name] = int(size)
+        return packs
+
+    def fsck(self, names):
+        cmd = ["bup", "fsck", "--jobs", str(self.jobs)]
+        if global_logger.verbose >= 3:
+            cmd += ["--verbose"]
+        cmd += [os.path.join(self.pack_dir(), name) for name in names]
+        return global_logger.check_call(repository_command(self.remote, cmd))
+
+    @profiled("verify-rotate")
+    def run(self, budget=None):
+        """verify the next slice of packs, returns (success, metrics)"""
+        timer = Timer()
+        try:
+            packs = self.packs()
+        except (OSError, subprocess.CalledProcessError) as e:
+            logging.warning("could not list packs: %s", e)
+            return False, {}
+        state = load_state(self.path)
+        # forget the packs bup gc removed
+        verified = {
+            name: stamp
+            for name, stamp in state.get(self.key, {}).items()
+            if name in packs
+        }
+        quota = sum(packs.values()) / self.days
+        queue = sorted(packs, key=lambda name: verified.get(name, 0))
+        success = True
+        done = 0
+        size = 0
+        while queue and size < quota:
+            if budget and timer.diff().total_seconds() > budget:
+                logging.warning("verification budget exhausted")
+                break
+            batch = queue[: self.jobs]
+            del queue[: self.jobs]
+            logging.info("verifying %d packs", len(batch))
+            if self.fsck(batch):
+                good = batch
+            else:
+                # find out which packs are damaged
+                good = [name for name in batch if self.fsck([name])]
+                for name in set(batch) - set(good):
+                    logging.error("pack %s failed verification", name)
+                success = False
+            now = time.time()
+            for name in good:
+                verified[name] = now
+            done += len(batch)
+            size += sum(packs[name] for name in batch)
+            state[self.key] = verified
+            save_state(self.path, state)
+
+        now = time.time()
+        ages = [(now - verified[name]) / 86400 for name in packs if name in verified]
+        overdue = len(packs) - sum(1 for age in ages if age <= self.days)
+        metrics = {
+            "verified_packs": done,
+            "verified_bytes": size,
+            "verify_seconds": timer.diff().total_seconds(),
+            "overdue_packs": overdue,
+            "oldest_verification_days": max(ages) if ages else None,
+        }
+        logging.info(
+            "verified %d packs (%s), %d of %d packs not verified in %d days",
+            done,
+            BupCronMetaData.format_bytes(size),
+            overdue,
+            len(packs),
+            self.days,
+        )
+        return success, metrics
+
+
+class Scheduler(object):
+    """decide which paths are due, for a bup-cron ran often by cron
+
+    time is cut in slots of each path's --interval, aligned on local
+    midnight, and a path is due when it was not saved yet in the
+    current slot. slots are shifted by an offset derived from the
+    hostname and the path, up to --jitter, so hosts sharing a
+    repository do not all start at the same time. the time of the last
+    save of each path is kept per repository in the cache directory"""
+
+    def __init__(self, remote_rep, intervals, jitter):
+        import socket
+
+        self.key = remote_rep or os.path.realpath(os.environ["BUP_DIR"])
+        self.path = os.path.join(cache_dir(), "schedule.json")
+        self.intervals = intervals
+        self.jitter = jitter
+        self.host = socket.gethostname()
+        self.last = load_state(self.path).get(self.key, {})
+        self.now = time.time()
+        self.ran = 0
+        self.lock = threading.Lock()
+
+    def offset(self, name, interval):
+        """the host specific shift of the slots of name, in seconds"""
+        import hashlib
+
+        jitter = min(self.jitter, interval)
+        if jitter < 1:
+            return 0
+        digest = hashlib.sha1(("%s\0%s" % (self.host, name)).encode()).hexdigest()
+        return int(digest, 16) % int(jitter)
+
+    def slot(self, name, interval, stamp):
+        local = stamp + time.localtime(stamp).tm_gmtoff
+        return (local - self.offset(name, interval)) // interval
+
+    def due(self, name):
+        """should name, a path or a pipe name, be saved in this run"""
+        interval = self.intervals.get(name)
+        last = self.last.get(name)
+        if interval is None or last is None:
+            return True
+        if self.slot(name, interval, self.now) > self.slot(name, interval, last):
+            return True
+        logging.info(
+            "skipping %s, saved %s ago, every %s",
+            name,
+            datetime.timedelta(seconds=int(self.now - last)),
+            datetime.timedelta(seconds=int(interval)),
+        )
+        return False
+
+    def done(self, name):
+        """remember name was saved in this run"""
+        with self.lock:
+            self.ran += 1
+            self.last[name] = self.now
+            # reload, parallel jobs may share the file
+            state = load_state(self.path)
+            state.setdefault(self.key, {})[name] = self.now
+            save_state(self.path, state)
+
+
+class RemoteQueue(object):
+    """hand the checks of a remote repository over to its server
+
+    instead of keeping the client and its lock busy while the server
+    runs bup fsck, the checks are written as a job file in a queue
+    directory on the server, processed by bup-cron --server-worker
+    (see QueueWorker), which is started right away if bup-cron is
+    installed there. the identifiers of the jobs submitted are kept in
+    the cache directory, and their results fetched on the next run."""
+
+    # seconds after which a job with no result is forgotten
+    expire = 7 * 24 * 3600
+
+    def __init__(self, remote_rep, queue, start_worker=True):
+        import shlex
+
+        self.remote = remote_rep
+        self.server, self.repository = remote_rep.split(":", 1)
+        self.queue = shlex.quote(queue)
+        self.start_worker = start_worker
+        self.path = os.path.join(cache_dir(), "remote-queue.json")
+
+    def ssh(self, script, data=None):
+        """run script on the server, returns its output or None"""
+        try:
+            return subprocess.run(
+                ["ssh", "-T", self.server, script],
+                input=data,
+                stdout=subprocess.PIPE,
+                check=True,
+                close_fds=True,
+            ).stdout
+        except (OSError, subprocess.CalledProcessError) as e:
+            logging.warning("could not reach the queue on %s: %s", self.server, e)
+            return None
+
+    def pending(self, state):
+        """the jobs of the remote in state, as an {id: submitted} dict"""
+        pending = state.get(self.remote, {})
+        if isinstance(pending, list):
+            # written by older versions, without the submission time
+            pending = dict.fromkeys(pending, time.time())
+        return pending
+
+    def collect(self):
+        """fetch the results of the jobs of previous runs, as dicts"""
+        import json
+
+        pending = self.pending(load_state(self.path))
+        if not pending:
+            return []
+        output = self.ssh(
+            "cd %s && for id in %s; do if [ -f done/$id.json ]; then "
+            "cat done/$id.json && rm -f done/$id.json; fi; done"
+            % (self.queue, " ".join(pending))
+        )
+        if output is None:
+            return []
+        results = []
+        for line in output.decode().splitlines():
+            try:
+                results.append(json.loads(line))
+            except ValueError:
+                continue
+        finished = {result.get("id") for result in results}
+        state = load_state(self.path)
+        pending = self.pending(state)
+        for i in finished:
+            pending.pop(i, None)
+        for i, submitted in list(pending.items()):
+            if time.time() - submitted > self.expire:
+                logging.warning(
+                    "remote job %s queued on %s has no result after %s, forgetting it",
+                    i,
+                    self.server,
+                    datetime.timedelta(seconds=int(time.time() - submitted)),
+                )
+                del pending[i]
+        state[self.remote] = pending
+        save_state(self.path, state)
+        if pending:
+            logging.info("%d remote jobs still queued on %s", len(pending), self.server)
+        return results
+
+    def submit(self, tasks, repair=False):
+        """queue tasks ("check", "parity") on the repository"""
+        import json
+        import socket
+        import uuid
+
+        job = {
+            "id": uuid.uuid4().hex,
+            "repository": self.repository or ".bup",
+            "tasks": tasks,
+            "repair": repair,
+            "client": socket.gethostname(),
+            "submitted": time.time(),
+        }
+        script = (
+            "mkdir -p {q}/new {q}/running {q}/done "
+            "&& cat > {q}/new/{id}.tmp && mv {q}/new/{id}.tmp {q}/new/{id}.json"
+        )
+        if self.start_worker:
+            script += (
+                " && if command -v bup-cron >/dev/null; then "
+                "nohup bup-cron --server-worker {q} </dev/null >/dev/null 2>&1 & fi"
+            )
+        script = script.format(q=self.queue, id=job["id"])
+        if self.ssh(script, json.dumps(job).encode()) is None:
+            return False
+        logging.info("queued %s on %s", " and ".join(tasks), self.server)
+        state = load_state(self.path)
+        state[self.remote] = self.pending(state)
+        state[self.remote][job["id"]] = job["submitted"]
+        save_state(self.path, state)
+        return True
+
+
+class QueueWorker(object):
+    """run the jobs clients put in a queue directory, see RemoteQueue
+
+    job files are claimed by moving them from new/ to running/, and
+    their results written to done/ for the clients to fetch. jobs of
+    different clients checking the same repository are ran once."""
+
+    def __init__(self, queue):
+        self.queue = queue
+
+    def dir(self, name):
+        return os.path.join(self.queue, name)
+
+    def pending(self):
+        """if jobs are waiting in the queue"""
+        try:
+            return any(name.endswith(".json") for name in os.listdir(self.dir("new")))
+        except OSError:
+            return False
+
+    def finish(self, job, success, started):
+        """write the result of job for its client"""
+        import json
+
+        result = dict(
+            job,
+            status="ok" if success else "failed",
+            started=started,
+            finished=time.time(),
+        )
+        path = os.path.join(self.dir("done"), "%s.json" % job["id"])
+        with open(path + ".tmp", "w") as f:
+            f.write(json.dumps(result) + "\n")
+        os.replace(path + ".tmp", path)
+
+    @staticmethod
+    def check(repository, tasks, repair):
+        """run the tasks on a local repository, returns True on success"""
+        os.environ["BUP_DIR"] = repository
+        success = True
+        if "check" in tasks and not Bup.fsck(None, repair=repair):
+            if not Bup.fsck(None):
+                logging.warning(
+                    "fsck found an error in %s and could not fix it", repository
+                )
+                success = False
+        if "parity" in tasks and not Bup.fsck(None, parity=True):
+            logging.warning("could not generate par2 parity blocks in %s", repository)
+            success = False
+        return success
+
+    def run(self):
+        """process the queue until it is empty, returns True if all jobs
+        succeeded. the caller holds the lock of the queue"""
+        import json
+
+        for name in ("new", "running", "done"):
+            make_dirs_helper(self.dir(name))
+        # left over by a worker that died
+        for name in os.listdir(self.dir("running")):
+            os.replace(
+                os.path.join(self.dir("running"), name),
+                os.path.join(self.dir("new"), name),
+            )
+        success = True
+        while True:
+            batches = {}
+            for name in sorted(os.listdir(self.dir("new"))):
+                if not name.endswith(".json"):
+                    continue
+                path = os.path.join(self.dir("running"), name)
+                os.replace(os.path.join(self.dir("new"), name), path)
+                try:
+                    with open(path) as f:
+                        job = json.load(f)
+                    repository = os.path.join(
+                        os.path.expanduser("~"), job["repository"]
+                    )
+                    key = (
+                        os.path.realpath(repository),
+                        tuple(sorted(job["tasks"])),
+                        bool(job.get("repair")),
+                    )
+                except (OSError, ValueError, KeyError, TypeError) as e:
+                    logging.warning("invalid job %s: %s", name, e)
+                    os.remove(path)
+                    continue
+                batches.setdefault(key, []).append((job, path))
+            if not batches:
+                return success
+            for (repository, tasks, repair), jobs in batches.items():
+                logging.info(
+                    "running %s on %s for %d queued jobs",
+                    " and ".join(tasks),
+                    repository,
+                    len(jobs),
+                )
+                started = time.time()
+                result = self.check(repository, tasks, repair)
+                success = result and success
+                for job, path in jobs:
+                    self.finish(job, result, started)
+                    os.remove(path)
+
+
+class Retention(object):
+    """count-based retention policy, evaluated on the saves of branches
+
+    for each period, the newest save of each of the last N periods
+    that have a save is kept, the newest save is always kept. this
+    is similar to the --keep-daily family of options of other backup
+    tools."""
+
+    """strftime formats defining the period a save falls in"""
+    periods = [("daily", "%Y-%m-%d"), ("weekly", "%G-W%V"), ("monthly", "%Y-%m")]
+
+    def __init__(self, daily=0, weekly=0, monthly=0):
+        self.keep = {"daily": daily, "weekly": weekly, "monthly": monthly}
+
+    def __bool__(self):
+        return any(self.keep.values())
+
+    def select(self, timestamps):
+        """return the set of timestamps to keep
+
+        timestamps are commit times in seconds since the epoch"""
+        timestamps = sorted(timestamps, reverse=True)
+        kept = set(timestamps[:1])
+        for period, fmt in self.periods:
+            seen = set()
+            for stamp in timestamps:
+                key = time.strftime(fmt, time.localtime(stamp))
+                if key in seen:
+                    continue
+                if len(seen) >= self.keep[period]:
+                    break
+                seen.add(key)
+                kept.add(stamp)
+        return kept
+
+    @staticmethod
+    def history(remote_rep, branches):
+        """return a dict mapping branches to the timestamps of their saves
+
+        this lists the history of all branches with a single git process"""
+        refs = ["refs/heads/" + b for b in branches]
+        cmd = ["git", "for-each-ref", "--format=%(refname)"] + refs
+        existing = subprocess.check_output(repository_command(remote_rep, cmd))
+        refs = existing.decode().split()
+        history = {}
+        if not refs:
+            return history
+        cmd = ["git", "log", "--source", "--no-notes", "--format=%at %S"] + refs
+        output = subprocess.check_output(repository_command(remote_rep, cmd))
+        for line in output.decode().splitlines():
+            stamp, ref = line.split(" ", 1)
+            branch = ref.replace("refs/heads/", "", 1)
+            history.setdefault(branch, []).append(int(stamp))
+        return history
+
+    @profiled("prune")
+    def prune(self, remote_rep, branches, budget=None, dry_run=False):
+        """remove the saves outside the policy from the given branches
+
+        stops when the time budget (in seconds) is exhausted, and
+        only collects garbage if there is budget left. returns a dict
+        mapping branches to the number of saves removed."""
+        import collections
+
+        timer = Timer()
+        removed = {}
+        history = Retention.history(remote_rep, branches)
+        for branch, timestamps in sorted(history.items()):
+            if budget and timer.diff().total_seconds() > budget:
+                logging.warning("prune budget exhausted, skipping %s", branch)
+                continue
+            kept = self.select(timestamps)
+            # saves sharing the same second get suffixes in bup,
+            # play it safe and never remove those
+            counts = collections.Counter(timestamps)
+            drop = [s for s in timestamps if s not in kept and counts[s] == 1]
+            if not drop:
+                continue
+            saves = [
+                "%s/%s" % (branch, time.strftime("%Y-%m-%d-%H%M%S", time.gmtime(s)))
+                for s in sorted(drop)
+            ]
+            if dry_run:
+                for save in saves:
+                    logging.warning("would remove %s", save)
+                continue
+            if Bup.rm(remote_rep, saves):
+                removed[branch] = len(saves)
+            else:
+                logging.warning("failed to remove old saves from %s", branch)
+        if removed:
+            if budget and timer.diff().total_seconds() > budget:
+                logging.warning("prune budget exhausted, skipping bup gc")
+            elif not Bup.gc(remote_rep):
+                logging.warning("bup gc failed")
+        return removed
+
+
+class JobRunner(object):
+    """run the jobs of job files from a single process
+
+    a job file has the same syntax as configuration files, except that
+    it is split in sections: options before the first section apply
+    to all jobs and each [section] defines a job, named after it, for
+    example:
+
+        repository=/srv/backups/bup
+        stats
+
+        [system]
+        path=/
+        path=/usr
+        snapshot
+
+        [mail]
+        path=/var/mail
+        exclude-rx=/spam/
+        after=system
+
+    each job is parsed as if its options were appended to the
+    commandline. jobs run in forked processes, at most --parallel-jobs
+    at once, and never concurrently with jobs sharing their resources
+    (repository, remote, snapshot devices). locks and version probes
+    are taken once for all jobs."""
+
+    section = re.compile(r"^\s*\[([^\]]+)\]\s*$")
+
+    def __init__(self, jobs, parallel=1):
+        """jobs is a dict mapping job names to their parsed arguments"""
+        self.jobs = jobs
+        self.parallel = max(parallel, 1)
+        # repositories created by init_repositories()
+        self.initialised = set()
+
+    @classmethod
+    def load(cls, parser, args, argv):
+        """parse the job files given in args
+
+        argv is the full commandline, including configuration files,
+        the options of each job are appended to it"""
+        jobs = {}
+        bup_dir = os.environ.get("BUP_DIR")
+        for path in args.job_file:
+            common = []
+            sections = {}
+            with open(path) as f:
+                for line in f.read().splitlines():
+                    match = cls.section.match(line)
+                    if match:
+                        name = match.group(1).strip()
+                        if name in jobs or name in sections:
+                            parser.error("duplicate job %s in %s" % (name, path))
+                        sections[name] = []
+                    elif sections:
+                        sections[list(sections)[-1]] += parser.convert_arg_line_to_args(
+                            line
+                        )
+                    else:
+                        common += parser.convert_arg_line_to_args(line)
+            for name, lines in sections.items():
+                if bup_dir is None:
+                    os.environ.pop("BUP_DIR", None)
+                else:
+                    os.environ["BUP_DIR"] = bup_dir
+                job = parser.parse_args(argv + common + lines)
+                job.job_file = None
+                job.job_name = name
+                jobs[name] = job
+        if not jobs:
+            parser.error("no job found in %s" % ", ".join(args.job_file))
+        for name, job in jobs.items():
+            for dep in job.after:
+                if dep not in jobs:
+                    parser.error("job %s depends on unknown job %s" % (name, dep))
+        return cls(jobs, args.parallel_jobs)
+
+    @staticmethod
+    def resources(job):
+        """the resources a job needs exclusive access to"""
+        resources = {"repository " + os.path.realpath(job.bup_dir)}
+        if job.remote:
+            resources.add("remote " + job.remote)
+        if job.snapshot != "NO":
+            # snapshot names are derived from the volume, not the job
+            resources.add("snapshot")
+        return resources
+
+    def pidfiles(self):
+        return sorted(set(job.pidfile for job in self.jobs.values()))
+
+    def init_repositories(self):
+        """create missing repositories, before they get locked
+
+        returns False if one of them could not be created"""
+        for job in self.jobs.values():
+            if job.bup_dir in self.initialised or os.path.exists(job.bup_dir):
+                continue
+            os.environ["BUP_DIR"] = job.bup_dir
+            if not Bup.init(job.remote):
+                return False
+            self.initialised.add(job.bup_dir)
+        return True
+
+    def run_job(self, name):
+        """run a single job, this is the entry point of job processes"""
+        job = self.jobs[name]
+        os.environ["BUP_DIR"] = job.bup_dir
+        logging.info("job %s starting", name)
+        if job.clear and not job.index_shards and job.bup_dir not in self.initialised:
+            if not Bup.clear_index():
+                logging.warning("failed to clear the index")
+        global_logger.restart()
+        if profiler is not None:
+            profiler.fork(name)
+        success = process(job)
+        if profiler is not None:
+            profiler.close()
+        # the process exits without running atexit handlers
+        global_logger.stop()
+        sys.exit(0 if success else 1)
+
+    def run(self):
+        """run all jobs, returns True if they all succeeded"""
+        import multiprocessing
+        from multiprocessing.connection import wait
+
+        context = multiprocessing.get_context("fork")
+        if any(job.stats for job in self.jobs.values()):
+            # probe once here instead of once per job process
+            VersionCache().get(
+                "local",
+                VersionCache.fingerprint(["bup", "git"]),
+                BupCronMetaData.local_versions,
+            )
+        pending = list(self.jobs)
+        running = {}
+        done = {}
+        while pending or running:
+            busy = set()
+            for name in running:
+                busy |= self.resources(self.jobs[name])
+            for name in list(pending):
+                job = self.jobs[name]
+                if any(dep not in done for dep in job.after):
+                    continue
+                if not all(done[dep] for dep in job.after):
+                    logging.error("skipping job %s, a dependency failed", name)
+                    done[name] = False
+                    pending.remove(name)
+                    continue
+                if len(running) >= self.parallel or busy & self.resources(job):
+                    continue
+                child = context.Process(
+                    target=self.run_job, args=(name,), name="bup-cron " + name
+                )
+                child.start()
+                running[name] = child
+                busy |= self.resources(job)
+                pending.remove(name)
+            if not running:
+                if pending:
+                    logging.error(
+                        "circular dependencies between jobs %s", ", ".join(pending)
+                    )
+                    done.update((name, False) for name in pending)
+                break
+            wait([p.sentinel for p in running.values()])
+            for name, child in list(running.items()):
+                if child.exitcode is None:
+                    continue
+                child.join()
+                done[name] = child.exitcode == 0
+                del running[name]
+                if done[name]:
+                    logging.info("job %s completed", name)
+                else:
+                    logging.warning(
+                        "job %s failed with status %d", name, child.exitcode
+                    )
+        return all(done.values())
 
 
 class Pidfile:
@@ -784,7 +3453,7 @@ class Pidfile:
     def create(self):
         """initialise pid file"""
         try:
-            logging.debug("locking pidfile %s" % self.pidfile)
+            logging.debug("locking pidfile %s", self.pidfile)
             self.pidfd = os.open(self.pidfile, os.O_CREAT | os.O_WRONLY | os.O_EXCL)
         except OSError as e:
             if e.errno == errno.EEXIST:
@@ -795,7 +3464,7 @@ class Pidfile:
                 else:
                     try:
                         os.remove(self.pidfile)
-                        logging.warning("removed stale lockfile %s" % (self.pidfile))
+                        logging.warning("removed stale lockfile %s", self.pidfile)
                         self.pidfd = os.open(
                             self.pidfile, os.O_CREAT | os.O_WRONLY | os.O_EXCL
                         )
@@ -816,7 +3485,7 @@ class Pidfile:
 
     def remove(self):
         """helper function to actually remove the pid file"""
-        logging.debug("removing pidfile %s" % self.pidfile)
+        logging.debug("removing pidfile %s", self.pidfile)
         os.remove(self.pidfile)
 
     def _check(self):
@@ -837,7 +3506,7 @@ class Pidfile:
                 pid = int(pidstr)
             except ValueError:
                 # not an integer
-                logging.debug("not an integer: %s" % pidstr)
+                logging.debug("not an integer: %s", pidstr)
                 return False
 
             # First check the proc filesystem, which may not be available.
@@ -849,11 +3518,11 @@ class Pidfile:
             except OSError as e:
                 if e.errno == errno.ESRCH:
                     # Not running
-                    logging.debug("process %d is not running" % pid)
+                    logging.debug("process %d is not running", pid)
                     return False
                 elif e.errno == errno.EPERM:
                     # No permission to signal this process!
-                    logging.debug("can't deliver signal to process %d" % pid)
+                    logging.debug("can't deliver signal to process %d", pid)
                     return pid
             else:
                 return pid
@@ -904,20 +3573,34 @@ class GlobalLogger(object):
         self.verbose = args.verbose
         self._log = args.logfile
         self._warn = sys.stderr
-
-        # setup python logging facilities
+        # path of the log file, if any
+        self.logfile = None
+        # the watchdog of check_call: timeouts per phase, None for all
+        self.timeouts = dict(args.timeout)
+        self.stall_timeout = args.stall_timeout
+        self.stall_retries = args.stall_retries
+        # the commands it killed, for the run report
+        self.events = []
+        json_format = args.log_format == "json"
+
+        # the handlers doing I/O run in a separate thread, fed through
+        # a queue, so a slow disk or syslog daemon does not stall the
+        # backup
+        from logging import handlers
+
+        outputs = []
         if args.syslog:
-            sl = logging.handlers.SysLogHandler(address="/dev/log")
-            sl.setFormatter(logging.Formatter("bup-cron[%(process)d]: %(message)s"))
+            sl = handlers.SysLogHandler(address="/dev/log")
+            if json_format:
+                sl.setFormatter(JsonFormatter("bup-cron[%(process)d]: "))
+            else:
+                sl.setFormatter(logging.Formatter("bup-cron[%(process)d]: %(message)s"))
             # convert syslog argument to a numeric value
             loglevel = getattr(logging, args.syslog.upper(), None)
             if not isinstance(loglevel, int):
                 raise ValueError("Invalid log level: %s" % loglevel)
             sl.setLevel(loglevel)
-            logging.getLogger("").addHandler(sl)
-            logging.debug("configured syslog level %s" % loglevel)
-        # log everything in main logger
-        logging.getLogger("").setLevel(logging.DEBUG)
+            outputs.append(sl)
         if args.logfile == sys.stdout or args.logfile == "/dev/stdout":
             sh = logging.StreamHandler()
             if args.verbose > 1:
@@ -927,35 +3610,240 @@ class GlobalLogger(object):
             else:
                 sh.setLevel(logging.WARNING)
             self._log = sh.stream
-            logging.getLogger("").addHandler(sh)
-            logging.debug("configured stdout level %s" % sh.level)
+            outputs.append(sh)
         else:
             # keep 52 weeks of logs
-            fh = logging.handlers.TimedRotatingFileHandler(
+            fh = handlers.TimedRotatingFileHandler(
                 args.logfile, when="W6", backupCount=52
             )
             # serve back the stream to other processes
             self._log = fh.stream
-            logging.getLogger("").addHandler(fh)
+            self.logfile = args.logfile
+            outputs.append(fh)
+        if json_format:
+            outputs[-1].setFormatter(JsonFormatter())
+        # log everything in main logger
+        logging.getLogger("").setLevel(logging.DEBUG)
+        self.outputs = outputs
+        self.start()
+        for output in outputs:
             logging.debug(
-                "configured file output to %s, level %s" % (args.logfile, fh.level)
+                "configured %s output, level %s", type(output).__name__, output.level
             )
 
-    def check_call(self, cmd):
+    def start(self):
+        """start the thread writing logs out"""
+        import atexit
+        import queue
+        from logging import handlers
+
+        self.queue = queue.SimpleQueue()
+        self.handler = handlers.QueueHandler(self.queue)
+        # records nothing would output are dropped before being formatted
+        self.handler.setLevel(min(output.level for output in self.outputs))
+        self.handler.addFilter(LogContext())
+        self.listener = handlers.QueueListener(
+            self.queue, *self.outputs, respect_handler_level=True
+        )
+        self.listener.start()
+        logging.getLogger("").addHandler(self.handler)
+        atexit.register(self.stop)
+
+    def stop(self):
+        """flush the logs, and stop the thread writing them"""
+        if self.listener is None:
+            return
+        logging.getLogger("").removeHandler(self.handler)
+        self.listener.stop()
+        self.listener = None
+
+    def restart(self):
+        """restart logging in a forked process, where the thread is gone"""
+        logging.getLogger("").removeHandler(self.handler)
+        self.listener = None
+        self.start()
+
+    # seconds between two checks of the watchdog
+    poll_interval = 5
+
+    def timeout(self, phase):
+        """the timeout for commands of phase, in seconds, or None"""
+        if phase is not None:
+            for name in (phase, phase.replace("bup-", "", 1)):
+                if name in self.timeouts:
+                    return self.timeouts[name]
+        return self.timeouts.get(None)
+
+    def check_call(self, cmd, env=None, output=None):
         """call a process, log it to the logfile
 
+        env, if provided, is merged into the environment of the process
+
+        output, if provided, is called with every line the process
+        writes on its standard error, which is then a pseudo-terminal
+        so the process reports its progress
+
+        the process is killed if it runs past the --timeout of the
+        current phase or stops doing I/O for --stall-timeout, then ran
+        again up to --stall-retries times
+
         return false if it fails, otherwise true"""
+        if env is not None:
+            env = dict(os.environ, **env)
+        command = " ".join(cmd)
+        phases = LogContext.state.phases
+        phase = phases[-1] if phases else None
+        timeout = self.timeout(phase)
+        watched = timeout is not None or self.stall_timeout is not None
+        attempts = 1 + self.stall_retries if watched else 1
+        for attempt in range(attempts):
+            if attempt:
+                logging.warning(
+                    "retrying `%s`, attempt %d of %d", command, attempt + 1, attempts
+                )
+            start = time.monotonic()
+            rc = None
+            try:
+                logging.debug(
+                    "calling command `%s`", command, extra={"command": command}
+                )
+                if self.verbose >= 2:
+                    stdout = self._log
+                else:
+                    stdout = subprocess.DEVNULL
+                stderr = self._warn
+                if output is not None:
+                    stderr, reader = self.relay(output)
+                try:
+                    if watched:
+                        rc = self.watch(cmd, stdout, stderr, env, timeout, phase)
+                    else:
+                        rc = subprocess.call(
+                            cmd, stdout=stdout, stderr=stderr, close_fds=True, env=env
+                        )
+                finally:
+                    if output is not None:
+                        os.close(stderr)
+                        reader.join()
+            finally:
+                duration = time.monotonic() - start
+                if profiler is not None:
+                    profiler.child(cmd, duration)
+                fields = {"command": command, "duration": duration, "rc": rc}
+                if rc == 0:
+                    logging.debug(
+                        "command done in %.3f seconds", duration, extra=fields
+                    )
+                elif rc is not None:
+                    logging.warning("command failed with status %s", rc, extra=fields)
+            if rc is not None:
+                return rc == 0
+        return False
+
+    def relay(self, output):
+        """open a pseudo-terminal calling output with each line written
+        to it, returns its slave end and the thread reading it"""
+        import pty
+
+        master, slave = pty.openpty()
+
+        def read():
+            pending = b""
+            while True:
+                try:
+                    data = os.read(master, 4096)
+                except OSError:
+                    # EIO once the last writer is gone
+                    data = b""
+                if not data:
+                    break
+                # progress lines are rewritten in place with \r
+                *lines, pending = re.split(rb"[\r\n]", pending + data)
+                for line in lines:
+                    if line:
+                        output(line.decode(errors="replace"))
+            if pending:
+                output(pending.decode(errors="replace"))
+            os.close(master)
+
+        thread = threading.Thread(target=read, daemon=True)
+        thread.start()
+        return slave, thread
+
+    def watch(self, cmd, stdout, stderr, env, timeout, phase):
+        """run cmd in its own session, killing it on timeout or stall
+
+        return its exit status, or None if it was killed"""
+        proc = subprocess.Popen(
+            cmd,
+            stdout=stdout,
+            stderr=stderr,
+            close_fds=True,
+            env=env,
+            start_new_session=True,
+        )
+        start = progress = time.monotonic()
+        io = None
         try:
-            logging.debug("calling command `%s`" % " ".join(cmd))
-            if self.verbose >= 2:
-                stdout = self._log
-            else:
-                stdout = subprocess.DEVNULL
-            subprocess.check_call(cmd, stdout=stdout, stderr=self._warn, close_fds=True)
-        except subprocess.CalledProcessError:
-            logging.warning("command failed")
-            return False
-        return True
+            while True:
+                try:
+                    return proc.wait(self.poll_interval)
+                except subprocess.TimeoutExpired:
+                    pass
+                now = time.monotonic()
+                counters = process_tree_io(proc.pid)
+                if counters != io:
+                    io, progress = counters, now
+                if timeout is not None and now - start > timeout:
+                    event = "timeout"
+                    logging.error(
+                        "command `%s` still running after %d seconds, killing it",
+                        " ".join(cmd),
+                        now - start,
+                    )
+                elif (
+                    self.stall_timeout is not None
+                    and io is not None
+                    and now - progress > self.stall_timeout
+                ):
+                    event = "stall"
+                    logging.error(
+                        "command `%s` did no I/O for %d seconds, killing it",
+                        " ".join(cmd),
+                        now - progress,
+                    )
+                else:
+                    continue
+                self.events.append(
+                    {
+                        "event": event,
+                        "phase": phase,
+                        "command": " ".join(cmd),
+                        "duration": now - start,
+                    }
+                )
+                self.kill(proc)
+                return None
+        except BaseException:
+            # do not leave it behind, it is out of reach of our signals
+            self.kill(proc)
+            raise
+
+    def kill(self, proc, grace=10):
+        """terminate the session of proc, forcefully after grace seconds"""
+        import signal
+
+        for sig in (signal.SIGTERM, signal.SIGKILL):
+            try:
+                os.killpg(proc.pid, sig)
+            except ProcessLookupError:
+                pass
+            try:
+                proc.wait(grace)
+                return
+            except subprocess.TimeoutExpired:
+                pass
+        proc.wait()
 
 
 class Timer(object):
@@ -994,6 +3882,158 @@ def quotes(parts):
     return " ".join(quote(p) for p in parts)
 
 
+_durations = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+
+
+def iter_paths(args):
+    """the paths to backup: those of the commandline, then those of the
+    --paths-from files, read line by line as they are backed up"""
+    for path in args.paths:
+        yield path
+    for filename in args.paths_from:
+        with contextlib.ExitStack() as stack:
+            if filename == "-":
+                f = sys.stdin
+            else:
+                f = stack.enter_context(open(filename))
+            for line in f:
+                path = line.rstrip("\n")
+                if path and not path.startswith("#"):
+                    yield path
+
+
+def parse_compress(value):
+    """argparse type for --compress: auto or a level from 0 to 9"""
+    if value.lower() == "auto":
+        return "auto"
+    if value.isdigit() and 0 <= int(value) <= 9:
+        return int(value)
+    raise argparse.ArgumentTypeError("expected auto or a level from 0 to 9")
+
+
+def parse_timeout(value):
+    """argparse type for --timeout: a (phase, seconds) tuple, phase is
+    None when the timeout applies to every phase"""
+    phase, _, duration = value.rpartition("=")
+    try:
+        return (phase or None, parse_duration(duration))
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def process_tree_io(session):
+    """return the bytes read and written by the processes of a session,
+    or None if /proc does not tell
+
+    commands watched by check_call lead their own session, so this
+    covers their children, like the ssh of a remote bup save"""
+    total = None
+    try:
+        pids = [pid for pid in os.listdir("/proc") if pid.isdigit()]
+    except OSError:
+        return None
+    for pid in pids:
+        try:
+            with open("/proc/%s/stat" % pid) as f:
+                stat = f.read()
+            # the command name is in parenthesis and may hold spaces
+            if int(stat.rpartition(")")[2].split()[3]) != session:
+                continue
+            with open("/proc/%s/io" % pid) as f:
+                counters = dict(line.split(": ") for line in f.read().splitlines())
+        except (OSError, ValueError, IndexError):
+            # the process is gone, or is not ours
+            continue
+        total = (total or 0) + int(counters["rchar"]) + int(counters["wchar"])
+    return total
+
+
+def parse_interval(value):
+    """argparse type for --interval: a (name, seconds) tuple"""
+    name, _, duration = value.rpartition("=")
+    if not name:
+        raise argparse.ArgumentTypeError("expected PATH=DURATION")
+    try:
+        return (name, parse_duration(duration))
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def parse_duration(value):
+    """convert a duration like 90, 90s, 15m, 12h, 7d or 2w to seconds"""
+    match = re.match(r"^\s*(\d+(?:\.\d*)?)\s*([smhdw]?)\s*$", value)
+    if not match:
+        raise ValueError("invalid duration: %s" % value)
+    return float(match.group(1)) * _durations[match.group(2) or "s"]
+
+
+def percentile(values, p):
+    """return the p-th percentile of a sorted list, interpolating linearly"""
+    if not values:
+        return None
+    rank = (len(values) - 1) * p / 100.0
+    low = int(rank)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+def repository_command(remote_rep, cmd, env=None):
+    """run a bup or git command on the repository, through ssh if remote
+
+    cmd is a list starting with "bup" or "git", env is a dict of
+    environment variables for remote commands (local ones should be
+    passed to check_call)"""
+    if cmd[0] == "git":
+        git_dir = remote_rep.split(":", 1)[1] if remote_rep else os.environ["BUP_DIR"]
+        cmd = ["git", "--git-dir", git_dir] + cmd[1:]
+    elif remote_rep:
+        cmd = ["bup", "-d", remote_rep.split(":", 1)[1]] + cmd[1:]
+    if not remote_rep:
+        return cmd
+    import shlex
+
+    prefix = ["%s=%s" % (k, shlex.quote(v)) for k, v in sorted((env or {}).items())]
+    server = remote_rep.split(":", 1)[0]
+    return ["ssh", "-T", server, " ".join(prefix + [shlex.quote(c) for c in cmd])]
+
+
+def cache_dir():
+    """directory where bup-cron caches host-wide data"""
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(base, "bup-cron")
+
+
+def load_state(path, default=None):
+    """load a JSON state file, returning default (or {}) if unusable"""
+    import json
+
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError) as e:
+        logging.debug("could not load state from %s: %s", path, e)
+        return {} if default is None else default
+
+
+def save_state(path, data):
+    """atomically write a JSON state file, only warning on failure
+
+    state files are caches and bookkeeping: failing to write one
+    should never fail a backup"""
+    import json
+
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    try:
+        make_dirs_helper(os.path.dirname(path))
+        with open(tmp, "w") as f:
+            json.dump(data, f, indent=1, sort_keys=True)
+        os.replace(tmp, path)
+        return True
+    except (IOError, OSError) as e:
+        logging.warning("could not save state to %s: %s", path, e)
+        return False
+
+
 def make_dirs_helper(path):
     """Create the directory if it does not exist
 
@@ -1016,25 +4056,53 @@ class BupCronMetaData(object):
     def __init__(self, remote=None):
         self.remote = remote
         self.sizes = []
-        self.versions()
+        # per-path details, filled in by process() before save()
+        self.branch = None
+        self.path = None
+        self.duration = None
+        self.commit = None
+        # other measurements about the path, name to number
+        self.metrics = {}
+        self.remote_fingerprint = None
+        # the first remote disk usage call also fingerprints the remote
+        # tools, which versions() needs
         self.disk_usage()
+        self.versions()
 
     def versions(self):
-        self.local_bup = (
-            subprocess.check_output(["bup", "--version"]).decode().rstrip("\n")
+        cache = VersionCache()
+        versions = cache.get(
+            "local", VersionCache.fingerprint(["bup", "git"]), self.local_versions
         )
-        git_output = subprocess.check_output(["git", "--version"]).decode().rstrip("\n")
-        self.local_git = re.match(r"git version (.*)", git_output).group(1)
-        self.local_python = platform.python_version()
+        self.local_bup = versions["bup"]
+        self.local_git = versions["git"]
+        self.local_python = "%d.%d.%d" % sys.version_info[:3]
         if self.remote:
-            server, repo_path = self.remote.split(":")
-            cmd = "bup --version ;" "git --version ;" "python --version 2>&1"
-            cmd = ["ssh", "-T", server, cmd]
-            logging.debug("calling command `%s`" % cmd)
-            bup, git, python = subprocess.check_output(cmd).decode().split("\n", 2)
-            self.remote_bup = bup
-            self.remote_git = re.match(r"git version (.*)", git).group(1)
-            self.remote_python = re.match(r"Python (.*)", python).group(1)
+            versions = cache.get(
+                "remote " + self.remote, self.remote_fingerprint, self.remote_versions
+            )
+            self.remote_bup = versions["bup"]
+            self.remote_git = versions["git"]
+            self.remote_python = versions["python"]
+
+    @staticmethod
+    def local_versions():
+        bup = subprocess.check_output(["bup", "--version"]).decode().rstrip("\n")
+        git_output = subprocess.check_output(["git", "--version"]).decode().rstrip("\n")
+        git = re.match(r"git version (.*)", git_output).group(1)
+        return {"bup": bup, "git": git}
+
+    def remote_versions(self):
+        server, repo_path = self.remote.split(":")
+        cmd = "bup --version ;" "git --version ;" "python --version 2>&1"
+        cmd = ["ssh", "-T", server, cmd]
+        logging.debug("calling command `%s`", cmd)
+        bup, git, python = subprocess.check_output(cmd).decode().split("\n", 2)
+        return {
+            "bup": bup,
+            "git": re.match(r"git version (.*)", git).group(1),
+            "python": re.match(r"Python (.*)", python).group(1),
+        }
 
     def disk_usage(self):
         if not self.remote:
@@ -1043,9 +4111,15 @@ class BupCronMetaData(object):
         else:
             server, repo_path = self.remote.split(":")
             obj_path = os.path.join(repo_path, "objects/pack")
-            cmd = ["ssh", "-T", server, " ".join(self.du_cmd), "'%s'" % obj_path]
-        logging.debug("calling command `%s`" % cmd)
-        self.sizes.append(int(subprocess.check_output(cmd).decode().split("\t")[0]))
+            cmd = " ".join(self.du_cmd) + " '%s'" % obj_path
+            if not self.sizes:
+                cmd = VersionCache.remote_fingerprint_cmd + "; echo --; " + cmd
+            cmd = ["ssh", "-T", server, cmd]
+        logging.debug("calling command `%s`", cmd)
+        output = subprocess.check_output(cmd).decode()
+        if self.remote and not self.sizes:
+            self.remote_fingerprint, output = output.rsplit("--\n", 1)
+        self.sizes.append(int(output.split("\t")[0]))
 
     @staticmethod
     def format_bytes(num, suffix="B"):
@@ -1065,7 +4139,7 @@ class BupCronMetaData(object):
 * Before: %s (%s bytes)
 * After: %s (%s bytes)
 * Diff: %s (%s bytes)
-
+%s
 Local versions
 
 *    bup: %s
@@ -1078,10 +4152,15 @@ Local versions
             self.sizes[-1],
             self.format_bytes(size_diff),
             size_diff,
+            "* Duration: %.1f seconds\n" % self.duration if self.duration else "",
             self.local_bup,
             self.local_git,
             self.local_python,
         )
+        if self.metrics:
+            str += "\nMeasurements\n\n"
+            for name, value in sorted(self.metrics.items()):
+                str += "* %s: %g\n" % (name, value)
         if self.remote:
             str += """
 Remote versions
@@ -1141,33 +4220,433 @@ Remote versions
             ]
         else:
             server, repo_path = self.remote.split(":")
+            # print the annotated commit in the same round trip
             cmd = [
                 "ssh",
                 "-T",
                 server,
-                "git --git-dir='{0}' notes add -F - '{1}'".format(
+                "git --git-dir='{0}' notes add -F - '{1}' &&"
+                " git --git-dir='{0}' rev-parse --verify '{1}'".format(
                     repo_path, self.branch
                 ),
             ]
-        logging.debug("calling command `%s`" % cmd)
+        logging.debug("calling command `%s`", cmd)
         process = subprocess.Popen(
             cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE
         )
         (out, err) = process.communicate(str(self).encode())
         if process.returncode != 0:
             logging.warning(
-                "failed to save bup note: `%s%s` (%d)" % (out, err, process.returncode)
+                "failed to save bup note: `%s%s` (%d)", out, err, process.returncode
             )
-        return process.returncode == 0
+            return False
+        if self.remote:
+            self.commit = out.decode().strip().split("\n")[-1] or None
+        else:
+            self.commit = self.rev_parse()
+        return True
+
+    def rev_parse(self):
+        """return the commit id the branch points to, or None"""
+        cmd = [
+            "git",
+            "--git-dir",
+            os.environ["BUP_DIR"],
+            "rev-parse",
+            "--verify",
+            "--quiet",
+            self.branch,
+        ]
+        try:
+            return subprocess.check_output(cmd).decode().strip()
+        except subprocess.CalledProcessError:
+            return None
+
+
+class VersionCache(object):
+    """on-disk cache of the versions of bup, git and python
+
+    those only change on upgrades, so probing them every run is
+    wasteful, especially remotely. versions are stored along with a
+    fingerprint of the binaries (path, inode and modification time)
+    and are only probed again when the fingerprint changes."""
+
+    """shell command listing the remote binaries, cheaper than running them"""
+    remote_fingerprint_cmd = (
+        'ls -ilL "$(command -v bup)" "$(command -v git)"'
+        ' "$(command -v python)" 2>/dev/null'
+    )
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(cache_dir(), "versions.json")
+        self.entries = load_state(self.path)
+
+    @staticmethod
+    def fingerprint(tools):
+        """fingerprint the given local tools, None if one is missing"""
+        import shutil
+
+        parts = []
+        for tool in tools:
+            path = shutil.which(tool)
+            if path is None:
+                return None
+            path = os.path.realpath(path)
+            st = os.stat(path)
+            parts.append("%s:%d:%d" % (path, st.st_ino, st.st_mtime_ns))
+        return " ".join(parts)
+
+    def get(self, key, fingerprint, probe):
+        """return the cached versions for key, or call probe to refresh them"""
+        entry = self.entries.get(key)
+        if fingerprint and entry and entry.get("fingerprint") == fingerprint:
+            logging.debug("using cached %s versions", key)
+            return entry["versions"]
+        versions = probe()
+        if fingerprint:
+            self.entries[key] = {"fingerprint": fingerprint, "versions": versions}
+            save_state(self.path, self.entries)
+        return versions
+
+
+class StatsDatabase(object):
+    """local SQLite store of structured backup statistics
+
+    every run gets a row in the runs table, and every measurement a
+    row in the metrics table, keyed by branch and metric name, so that
+    new kinds of measurements do not require schema changes."""
+
+    """default location of the database, relative to $BUP_DIR"""
+    filename = "bup-cron-stats.sqlite"
+
+    schema = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    host TEXT,
+    source TEXT,
+    started REAL,
+    finished REAL,
+    success INTEGER,
+    remote TEXT,
+    local_bup TEXT,
+    local_git TEXT,
+    local_python TEXT,
+    remote_bup TEXT,
+    remote_git TEXT,
+    remote_python TEXT
+);
+CREATE TABLE IF NOT EXISTS metrics (
+    run_id INTEGER REFERENCES runs(id),
+    timestamp REAL,
+    branch TEXT,
+    path TEXT,
+    commit_id TEXT,
+    name TEXT,
+    value REAL
+);
+CREATE INDEX IF NOT EXISTS metrics_name ON metrics (name, branch, timestamp);
+CREATE UNIQUE INDEX IF NOT EXISTS metrics_commit ON metrics (commit_id, name);
+"""
 
+    """regular expressions used to parse the notes left by BupCronMetaData"""
+    note_patterns = {
+        "size_before": r"^\* Before: .* \((-?\d+) bytes\)$",
+        "size_after": r"^\* After: .* \((-?\d+) bytes\)$",
+        "size_diff": r"^\* Diff: .* \((-?\d+) bytes\)$",
+        "duration": r"^\* Duration: ([\d.]+) seconds$",
+    }
 
+    """free-form measurements, in the Measurements section of notes"""
+    note_metric_pattern = r"^\* ([a-z_]+): (-?[\d.]+(?:e[-+]?\d+)?)$"
+
+    def __init__(self, path):
+        import sqlite3
+
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript(self.schema)
+
+    def start_run(self, metadata=None, source="run", started=None):
+        """create a run row and return its id"""
+        import socket
+
+        row = {
+            "host": socket.gethostname(),
+            "source": source,
+            "started": started or time.time(),
+        }
+        if metadata is not None:
+            row["remote"] = metadata.remote
+            for where in ["local", "remote"]:
+                for tool in ["bup", "git", "python"]:
+                    key = "%s_%s" % (where, tool)
+                    row[key] = getattr(metadata, key, None)
+        cur = self.conn.execute(
+            "INSERT INTO runs (%s) VALUES (%s)"
+            % (", ".join(row), ", ".join("?" * len(row))),
+            list(row.values()),
+        )
+        self.conn.commit()
+        return cur.lastrowid
+
+    def finish_run(self, run_id, success):
+        self.conn.execute(
+            "UPDATE runs SET finished = ?, success = ? WHERE id = ?",
+            (time.time(), int(success), run_id),
+        )
+        self.conn.commit()
+
+    def record(self, run_id, branch, path, metrics, commit=None, timestamp=None):
+        """store a dict of metric name to value for the given branch
+
+        measurements already imported for the same commit are ignored"""
+        timestamp = timestamp or time.time()
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO metrics"
+            " (run_id, timestamp, branch, path, commit_id, name, value)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [
+                (run_id, timestamp, branch, path, commit, name, value)
+                for name, value in metrics.items()
+                if value is not None
+            ],
+        )
+        self.conn.commit()
+
+    def record_metadata(self, run_id, metadata):
+        """store the per-path measurements of a BupCronMetaData object"""
+        self.record(
+            run_id,
+            metadata.branch,
+            metadata.path,
+            {
+                "duration": metadata.duration,
+                "size_before": metadata.sizes[-2],
+                "size_after": metadata.sizes[-1],
+                "size_diff": metadata.sizes[-1] - metadata.sizes[-2],
+                **metadata.metrics,
+            },
+            commit=metadata.commit,
+        )
+
+    def backfill(self, git_dir):
+        """import the statistics stored as git notes in the repository
+
+        this uses a constant number of git processes: one to list the
+        notes, one to map commits to branches and timestamps and one
+        to read all the notes in a batch."""
+        git = ["git", "--git-dir", git_dir]
+        notes = {}
+        for line in subprocess.check_output(git + ["notes", "list"]).splitlines():
+            note, commit = line.decode().split()
+            notes[commit] = note
+        if not notes:
+            return 0
+        commits = {}
+        log = subprocess.check_output(
+            git + ["log", "--branches", "--source", "--format=%H %ct %S", "--no-notes"]
+        )
+        for line in log.decode().splitlines():
+            commit, stamp, branch = line.split(" ", 2)
+            commits.setdefault(
+                commit, (float(stamp), branch.replace("refs/heads/", ""))
+            )
+        process = subprocess.Popen(
+            git + ["cat-file", "--batch"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+        out, _ = process.communicate("\n".join(notes.values()).encode() + b"\n")
+        bodies = {}
+        offset = 0
+        while offset < len(out):
+            end = out.index(b"\n", offset)
+            sha, kind, size = out[offset:end].decode().split()
+            start = end + 1
+            offset = start + int(size)
+            bodies[sha] = out[start:offset].decode(errors="replace")
+            # skip the newline terminating the object
+            offset += 1
+        run_id = self.start_run(source="notes")
+        imported = 0
+        for commit, note in notes.items():
+            if commit not in commits or note not in bodies:
+                continue
+            timestamp, branch = commits[commit]
+            metrics = {}
+            for name, pattern in self.note_patterns.items():
+                match = re.search(pattern, bodies[note], re.MULTILINE)
+                if match:
+                    metrics[name] = float(match.group(1))
+            for name, value in re.findall(
+                self.note_metric_pattern, bodies[note], re.MULTILINE
+            ):
+                metrics[name] = float(value)
+            if metrics:
+                self.record(run_id, branch, None, metrics, commit, timestamp)
+                imported += 1
+        self.finish_run(run_id, True)
+        return imported
+
+    def query(self, names=None, branch=None, since=None, until=None, group_by=None):
+        """return a dict mapping (group, name) to a sorted list of values"""
+        group = {
+            # metrics about the whole run, like maintenance, have no branch
+            None: "COALESCE(branch, '-')",
+            "branch": "COALESCE(branch, '-')",
+            "host": "runs.host",
+            "day": "strftime('%Y-%m-%d', timestamp, 'unixepoch')",
+            "week": "strftime('%Y-W%W', timestamp, 'unixepoch')",
+            "month": "strftime('%Y-%m', timestamp, 'unixepoch')",
+        }[group_by]
+        sql = (
+            "SELECT %s, name, value FROM metrics JOIN runs ON runs.id = run_id"
+            " WHERE 1" % group
+        )
+        params = []
+        if names:
+            sql += " AND name IN (%s)" % ", ".join("?" * len(names))
+            params += names
+        if branch:
+            sql += " AND branch GLOB ?"
+            params.append(branch)
+        if since:
+            sql += " AND timestamp >= ?"
+            params.append(since)
+        if until:
+            sql += " AND timestamp < ?"
+            params.append(until)
+        results = {}
+        for key, name, value in self.conn.execute(sql + " ORDER BY value", params):
+            results.setdefault((key, name), []).append(value)
+        return results
+
+
+def pack_bytes(remote_rep):
+    """size of the packs of a local repository, or None"""
+    if remote_rep:
+        return None
+    directory = os.path.join(os.environ["BUP_DIR"], "objects", "pack")
+    try:
+        return sum(
+            e.stat().st_size
+            for e in os.scandir(directory)
+            if e.name.endswith((".pack", ".idx"))
+        )
+    except OSError:
+        return None
+
+
+def set_pack_size_limit(remote_rep, limit):
+    """set pack.packSizeLimit in the repository configuration
+
+    the last value set is remembered in the cache directory, to skip
+    the (possibly remote) git call on every run"""
+    path = os.path.join(cache_dir(), "pack-size-limit.json")
+    key = remote_rep or os.path.realpath(os.environ["BUP_DIR"])
+    state = load_state(path)
+    if state.get(key) == limit:
+        return
+    cmd = repository_command(remote_rep, ["git", "config", "pack.packSizeLimit", limit])
+    if global_logger.check_call(cmd):
+        state[key] = limit
+        save_state(path, state)
+    else:
+        logging.warning("could not set pack.packSizeLimit to %s", limit)
+
+
+@profiled("process")
 def process(args):
     """main processing loop"""
+    import socket
+
     success = True
+    Bup.library = None
+    if args.engine == "auto" and (args.timeout or args.stall_timeout):
+        # only processes can be killed by the watchdog
+        logging.info("running bup in processes, for --timeout and --stall-timeout")
+    elif args.engine != "subprocess":
+        library = BupLibrary(fallback=args.engine == "auto")
+        if library.load():
+            Bup.library = library
+        elif args.engine == "library":
+            logging.error("cannot load the bup library, see --engine")
+            return False
     if args.stats:
         args.stats = BupCronMetaData(args.remote)
-    # current lvm object to cleanup in exception handlers
-    for path in args.paths:
+    if args.stats_db:
+        args.stats_db = StatsDatabase(args.stats_db_path)
+        run_id = args.stats_db.start_run(args.stats)
+    queue = None
+    if args.remote_queue and not args.remote:
+        logging.warning("--remote-queue needs --remote, checking synchronously")
+    elif args.remote_queue:
+        queue = RemoteQueue(args.remote, args.remote_queue, args.start_worker)
+        failed = 0
+        for result in queue.collect():
+            when = datetime.datetime.fromtimestamp(int(result.get("submitted", 0)))
+            what = " and ".join(result.get("tasks", []))
+            if result.get("status") == "ok":
+                logging.info("remote %s queued on %s succeeded", what, when)
+            else:
+                logging.error("remote %s queued on %s failed", what, when)
+                failed += 1
+                success = False
+        if args.stats_db and failed:
+            args.stats_db.record(run_id, None, None, {"remote_job_failures": failed})
+    retention = Retention(args.keep_daily, args.keep_weekly, args.keep_monthly)
+    branches = []
+    tuner = None
+    compress = args.compress
+    if compress == "auto":
+        tuner = CompressionTuner(args.remote)
+        compress = tuner.level
+    if args.pack_size_limit:
+        set_pack_size_limit(args.remote, args.pack_size_limit)
+    preflight = Preflight(args.remote) if args.preflight else None
+    FreezeSnapshot.needed = [args.verify_dir] if args.verify_dir else []
+    if args.stats_db:
+        FreezeSnapshot.needed.append(args.stats_db_path)
+    page_cache = None
+    Bup.scope = []
+    if args.memory_high:
+        page_cache = PageCache(args.memory_high)
+        Bup.scope = page_cache.scope
+        if Bup.scope and Bup.library is not None:
+            # the cgroup only holds the processes ran in it
+            logging.warning("--memory-high: running bup in processes, not in-process")
+            Bup.library = None
+    scanner = None
+    if args.exclude_caches or args.exclude_nodump:
+        scanner = ExcludeScanner(args.exclude_caches, args.exclude_nodump, args.exclude)
+    scheduler = None
+    if args.interval:
+        intervals = {} if args.ignore_schedule else dict(args.interval)
+        scheduler = Scheduler(args.remote, intervals, args.jitter)
+
+    def record_stats(branch, path, timer):
+        args.stats.branch = branch
+        args.stats.path = path
+        args.stats.duration = timer.diff().total_seconds()
+        args.stats.save()
+        logging.info(args.stats.last_diff())
+        if args.stats_db:
+            args.stats_db.record_metadata(run_id, args.stats)
+
+    def backup(path):
+        """index and save a path, returns False on failure"""
+        success = True
+        LogContext.state.fields = {"path": path}
+        indexfile = None
+        if args.index_shards:
+            indexfile = Bup.shard(path)
+            if args.clear or path in args.clear_path:
+                if not Bup.clear_index(indexfile):
+                    logging.warning("failed to clear the index of %s", path)
+        path_timer = Timer()
+        kills = len(global_logger.events)
+        if args.stats:
+            args.stats.metrics = {}
         with Snapshot.select(args.snapshot)(
             path,
             args.size,
@@ -1177,6 +4656,12 @@ def process(args):
             global_logger.check_call,
             args.mountpoint,
         ) as snapshot:
+            excludes_from = args.exclude_from
+            if scanner:
+                excludes, metrics = scanner.scan(snapshot.path, snapshot.src_path)
+                excludes_from = (excludes_from or []) + [excludes]
+                if args.stats:
+                    args.stats.metrics.update(metrics)
             # XXX: this shouldn't be in the loop like this, bup index should be
             # able to index multiple paths
             #
@@ -1185,13 +4670,13 @@ def process(args):
                 snapshot.path,
                 args.exclude,
                 args.exclude_rx,
-                args.exclude_from,
+                excludes_from,
                 args.exclude_rx_from,
                 True,
+                indexfile,
             ):
                 logging.error("Skipping save because index failed!")
-                success = False
-                continue
+                return False
 
             if args.branch_name:
                 branch = args.branch_name
@@ -1200,11 +4685,78 @@ def process(args):
                     args.name if args.name else socket.gethostname(),
                     snapshot.src_path.replace("/", "_"),
                 )
-            if not Bup.save([snapshot.path], branch, snapshot.path, args.remote):
-                logging.error("bup save failed on %s" % snapshot.path)
+            LogContext.state.fields["branch"] = branch
+            if preflight:
+                if not preflight.check(branch, snapshot.path, indexfile):
+                    logging.error("Skipping save because it would not fit!")
+                    return False
+            growth = {}
+            # bup save only runs in a terminal to account for the save
+            report = SaveReport() if args.stats else None
+            # parallel saves grow the same packs directory
+            packs = pack_bytes(args.remote) if workers == 1 else None
+            start = time.monotonic()
+            with contextlib.ExitStack() as stack:
+                if tuner:
+                    stack.enter_context(tuner.measure())
+                if page_cache:
+                    cache = stack.enter_context(
+                        page_cache.guard(snapshot.path, args.remote, indexfile)
+                    )
+                saved = Bup.save(
+                    [snapshot.path],
+                    branch,
+                    snapshot.path,
+                    args.remote,
+                    compress,
+                    indexfile,
+                    report,
+                )
+            seconds = time.monotonic() - start
+            written = None
+            if packs is not None:
+                after = pack_bytes(args.remote)
+                written = after - packs if after is not None else None
+            if preflight and saved and written is not None:
+                growth = preflight.record(branch, written)
+            if saved and report:
+                growth.update(report.metrics(written, seconds))
+            if page_cache:
+                growth.update(cache)
+            if not saved:
+                logging.error("bup save failed on %s", snapshot.path)
+                success = False
+            else:
+                if branch not in branches:
+                    branches.append(branch)
+                if scheduler:
+                    scheduler.done(path)
+            if saved:
+                snapshot.check()
+            if saved and snapshot.invalid:
+                logging.error(
+                    "snapshot of %s went bad during the save, the backup is unreliable",
+                    snapshot.src_path,
+                )
                 success = False
 
-            if args.check and not Bup.fsck(args.remote, repair=args.repair):
+            if args.verify_sample > 0 and saved:
+                verifier = SampleVerifier(
+                    args.verify_sample, args.verify_dir, args.verify_jobs
+                )
+                metrics = verifier.verify(snapshot.path, branch, args.remote, indexfile)
+                if metrics["verify_failures"]:
+                    logging.error("restore verification failed on %s", snapshot.path)
+                    success = False
+                if args.stats:
+                    args.stats.metrics.update(metrics)
+
+            # with --remote-queue, checks are queued once, after all paths
+            if (
+                args.check
+                and not queue
+                and not Bup.fsck(args.remote, repair=args.repair)
+            ):
                 # it could have found an error and fixed it, check again
                 # XXX: we could check if fsck returns 100 (which means
                 # success) but that would mean refactoring all of
@@ -1215,40 +4767,328 @@ def process(args):
                     )
                     success = False
 
-            if args.parity and not Bup.fsck(args.remote, parity=True):
+            if args.parity and not queue and not Bup.fsck(args.remote, parity=True):
                 logging.warning("could not generate par2 parity blocks")
 
             if args.stats:
-                args.stats.branch = branch
-                args.stats.save()
-                logging.info(args.stats.last_diff())
+                args.stats.metrics.update(snapshot.metrics())
+                if compress is not None:
+                    args.stats.metrics["compress_level"] = compress
+                args.stats.metrics.update(growth)
+                if len(global_logger.events) > kills:
+                    args.stats.metrics["watchdog_kills"] = (
+                        len(global_logger.events) - kills
+                    )
+                record_stats(branch, snapshot.src_path, path_timer)
+                if preflight and saved:
+                    # remote repositories are only measured here
+                    sizes = args.stats.sizes
+                    preflight.record(branch, sizes[-1] - sizes[-2])
+        return success
+
+    # paths share measurements or state in those cases
+    serial = [
+        name
+        for name, used in (
+            ("--snapshot", args.snapshot != "NO"),
+            ("--stats", args.stats),
+            ("--preflight", preflight),
+            ("--compress auto", tuner),
+            ("--profile", profiler),
+            ("--engine library", Bup.library),
+        )
+        if used
+    ]
+    workers = args.parallel_paths
+    if workers > 1 and not args.index_shards:
+        logging.warning("--parallel-paths needs --index-shards, ignoring it")
+        workers = 1
+    elif workers > 1 and serial:
+        logging.info("saving paths one at a time because of %s", ", ".join(serial))
+        workers = 1
+    paths = (p for p in iter_paths(args) if not scheduler or scheduler.due(p))
+    if workers > 1:
+        from concurrent.futures import ThreadPoolExecutor
+
+        with ThreadPoolExecutor(workers) as pool:
+            for saved in pool.map(backup, paths):
+                success = saved and success
+    else:
+        for path in paths:
+            success = backup(path) and success
+
+    for spec in args.pipe:
+        path_timer = Timer()
+        if args.stats:
+            args.stats.metrics = {}
+        source = PipeSource(spec)
+        if scheduler and not scheduler.due(source.name):
+            continue
+        branch = "%s-pipe-%s" % (
+            args.name if args.name else socket.gethostname(),
+            source.name,
+        )
+        LogContext.state.fields = {"branch": branch}
+        if not source.save(branch, args.remote):
+            logging.error("could not save the output of pipe %s", source.name)
+            success = False
+            continue
+        branches.append(branch)
+        if scheduler:
+            scheduler.done(source.name)
+        if args.stats:
+            seconds = path_timer.diff().total_seconds()
+            args.stats.metrics["stream_bytes"] = source.bytes
+            if seconds:
+                args.stats.metrics["stream_mbps"] = source.bytes / seconds / 1e6
+            record_stats(branch, None, path_timer)
+
+    LogContext.state.fields = {}
+    if tuner:
+        tuner.update()
+
+    if retention and branches:
+        removed = retention.prune(
+            args.remote, branches, args.prune_budget, args.prune_dry_run
+        )
+        for branch, count in removed.items():
+            logging.info("removed %d old saves from %s", count, branch)
+            if args.stats_db:
+                args.stats_db.record(run_id, branch, None, {"pruned_saves": count})
+
+    # nothing was saved, the repository has not changed since
+    idle = scheduler is not None and not scheduler.ran and success
+
+    if args.maintain and not idle:
+        # after pruning, as bup gc rewrites packs
+        metrics = Maintenance(args.remote).run(args.maintain_budget)
+        if args.stats_db:
+            args.stats_db.record(run_id, None, None, metrics)
+
+    if args.verify_rotate > 0 and not idle:
+        verifier = RotatingVerifier(args.remote, args.verify_rotate, args.verify_jobs)
+        verified, metrics = verifier.run(args.verify_budget)
+        if not verified:
+            logging.error("repository verification found damaged packs")
+            success = False
+        if args.stats_db:
+            args.stats_db.record(run_id, None, None, metrics)
+
+    tasks = [task for task in ("check", "parity") if getattr(args, task)]
+    if queue and tasks and branches:
+        if not queue.submit(tasks, args.repair):
+            logging.error("could not queue %s on the server", " and ".join(tasks))
+            success = False
+
+    for event in global_logger.events:
+        logging.warning(
+            "%s: killed `%s` after %d seconds (%s)",
+            event["phase"],
+            event["command"],
+            event["duration"],
+            event["event"],
+        )
+    if args.stats_db and global_logger.events:
+        args.stats_db.record(
+            run_id, None, None, {"watchdog_kills": len(global_logger.events)}
+        )
 
     if args.stats:
         logging.info(args.stats.summary())
+    if args.stats_db:
+        args.stats_db.finish_run(run_id, success)
     return success
 
 
+def stats_main(argv):
+    """entry point of the `bup-cron stats` subcommand"""
+    parser = argparse.ArgumentParser(
+        prog="bup-cron stats",
+        description="""query the statistics database filled by
+                       --stats-db, or import existing git notes into it""",
+    )
+    parser.add_argument(
+        "-d",
+        "--repository",
+        default=os.environ.get("BUP_DIR"),
+        help="""repository to read notes from and
+                to find the database in, defaults to $BUP_DIR""",
+    )
+    parser.add_argument(
+        "--db",
+        default=None,
+        help="""path to the database, defaults to
+                $BUP_DIR/%s"""
+        % StatsDatabase.filename,
+    )
+    parser.add_argument(
+        "--import",
+        dest="backfill",
+        action="store_true",
+        help="""import the statistics stored as git notes
+                in the repository before querying""",
+    )
+    parser.add_argument(
+        "-b",
+        "--branch",
+        default=None,
+        help="""only consider branches matching this glob pattern""",
+    )
+    parser.add_argument(
+        "--metric",
+        action="append",
+        help="""only report this metric (e.g. duration, size_diff),
+                can be repeated, defaults to all metrics""",
+    )
+    parser.add_argument(
+        "--since",
+        default=None,
+        help="""only consider runs since this date (YYYY-MM-DD)
+                or duration ago (e.g. 30d)""",
+    )
+    parser.add_argument(
+        "--until",
+        default=None,
+        help="""only consider runs before this date
+                or duration ago""",
+    )
+    parser.add_argument(
+        "--group-by",
+        default="branch",
+        choices=["branch", "host", "day", "week", "month"],
+        help="""how to group measurements, default: %(default)s""",
+    )
+    parser.add_argument(
+        "-p",
+        "--percentile",
+        action="append",
+        type=float,
+        help="""percentile to report, can be repeated,
+                defaults to 50, 90 and 99""",
+    )
+    args = parser.parse_args(argv)
+    if args.db is None:
+        if not args.repository:
+            parser.error("argument -d/--repository or --db is required")
+        args.db = os.path.join(args.repository, StatsDatabase.filename)
+
+    def timestamp(value):
+        if value is None:
+            return None
+        try:
+            return time.time() - parse_duration(value)
+        except ValueError:
+            pass
+        try:
+            return time.mktime(time.strptime(value, "%Y-%m-%d"))
+        except ValueError:
+            parser.error("invalid date or duration: %s" % value)
+
+    db = StatsDatabase(args.db)
+    if args.backfill:
+        if not args.repository:
+            parser.error("argument -d/--repository is required with --import")
+        count = db.backfill(args.repository)
+        print("imported statistics from %d notes" % count, file=sys.stderr)
+    percentiles = args.percentile or [50, 90, 99]
+    results = db.query(
+        args.metric,
+        args.branch,
+        timestamp(args.since),
+        timestamp(args.until),
+        args.group_by,
+    )
+    print(
+        "\t".join(
+            [args.group_by, "metric", "count", "min"]
+            + ["p%g" % p for p in percentiles]
+            + ["max", "total"]
+        )
+    )
+    for (key, name), values in sorted(results.items()):
+        print(
+            "\t".join(
+                [str(key), name, str(len(values)), "%g" % values[0]]
+                + ["%g" % percentile(values, p) for p in percentiles]
+                + ["%g" % values[-1], "%g" % sum(values)]
+            )
+        )
+    return 0
+
+
 def bail(status, timer, msg=None):
     """cleanup on exit"""
+    if profiler is not None:
+        profiler.close()
     if msg:
         logging.warning(msg)
-    logging.info("bup-cron %s completed, %s" % (__version__, timer))
+    logging.info("bup-cron %s completed, %s", __version__, timer)
     sys.exit(status)
 
 
 def main():
     """main entry point, sets up error handlers and parses arguments"""
 
-    global global_logger
+    global global_logger, profiler
+
+    # fast path for monitoring probes, before any config file is read
+    if sys.argv[1:] == ["--version"]:
+        sys.stdout.write(__version__ + "\n")
+        return
+    if sys.argv[1:] == ["--copyright"]:
+        sys.stdout.write(__license__)
+        return
+
+    import locale
 
     locale.setlocale(locale.LC_ALL, "")
-    args = ArgumentConfigParser().parse_args()
+    if sys.argv[1:2] == ["stats"]:
+        if os.path.exists("stats"):
+            sys.stderr.write(
+                "bup-cron: running the stats subcommand, "
+                "use ./stats to back up the stats directory\n"
+            )
+        sys.exit(stats_main(sys.argv[2:]))
+    parser = ArgumentConfigParser()
+    args = parser.parse_args()
     timer = Timer()
 
     # initialize GlobalLogger singleton
     global_logger = GlobalLogger(args)
 
-    logging.info("bup-cron %s starting" % __version__)
+    logging.info("bup-cron %s starting", __version__)
+    if args.profile:
+        profiler = Profiler(args.profile)
+    if args.server_worker:
+        make_dirs_helper(args.server_worker)
+        worker = QueueWorker(args.server_worker)
+        success = True
+        while True:
+            try:
+                with Pidfile(os.path.join(args.server_worker, "worker.pid")):
+                    success = worker.run() and success
+            except ProcessRunningException:
+                logging.info("another worker is processing %s", args.server_worker)
+                break
+            # a worker started by a client while the lock was still
+            # held gave up, the jobs it was started for are ours
+            if not worker.pending():
+                break
+        if success:
+            bail(0, timer)
+        bail(1, timer, "one or more queued jobs failed")
+    if args.job_file:
+        runner = JobRunner.load(parser, args, sys.argv[1:])
+        if not runner.init_repositories():
+            bail(3, timer, "failed to initialize bup repo")
+        with contextlib.ExitStack() as locks:
+            for pidfile in runner.pidfiles():
+                locks.enter_context(Pidfile(pidfile))
+            success = runner.run()
+        if success:
+            bail(0, timer)
+        else:
+            bail(1, timer, "one or more jobs failed to complete")
     try:
         initialised = False
         if not os.path.exists(os.environ["BUP_DIR"]):
@@ -1257,9 +5097,9 @@ def main():
             initialised = True
 
         with Pidfile(args.pidfile):
-            if args.clear and not initialised:
+            if args.clear and not args.index_shards and not initialised:
                 if not Bup.clear_index():
-                    logging.warninging("failed to clear the index")
+                    logging.warning("failed to clear the index")
 
             success = process(args)
     except SystemExit:
@@ -1267,6 +5107,8 @@ def main():
     except:  # noqa
         raise
         # Get exception type and error, but print the traceback in debug only.
+        import traceback
+
         t, e, b = sys.exc_info()
         if args.debug:
             logging.warning(traceback.print_tb(b))
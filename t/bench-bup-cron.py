@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+
+"""measure the orchestration overhead of bup-cron itself
+
+This puts stub `bup`, `git`, `ssh`, `du`, `lvs`, `lvcreate`, `mount`
+and friends in front of the $PATH, so no real backup happens and what
+remains is bup-cron's own work: argument parsing, process spawns,
+statistics probes and snapshot probes. Every stub call is recorded
+with its latency, so regressions in the number of spawns and ssh round
+trips show up next to the timings.
+
+Usage: ./t/bench-bup-cron.py [--paths 1,10,100] [--repeat 5] [--json]
+"""
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+top = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, top)
+
+import bup_cron  # noqa: E402
+
+# every stub logs "name depth start end args..." to $BENCH_LOG, using
+# bash's $EPOCHREALTIME to avoid spawning date(1) from the stub
+# itself. depth is non-zero for commands ran through the ssh stub.
+stub_header = """#!/bin/bash
+start=$EPOCHREALTIME
+depth=${BENCH_DEPTH:-0}
+export BENCH_DEPTH=$((depth + 1))
+trap 'echo "${0##*/} $depth $start $EPOCHREALTIME $*" >> "$BENCH_LOG"' EXIT
+"""
+
+stubs = {
+    "bup": """
+case "$1" in
+    --version) echo 0.33-bench ;;
+    init) mkdir -p "$BUP_DIR/objects/pack" ;;
+esac
+true
+""",
+    "git": """
+case "$*" in
+    --version) echo "git version 2.39.0-bench" ;;
+    *rev-parse*) echo 0123456789abcdef0123456789abcdef01234567 ;;
+    *notes*) cat > /dev/null ;;
+esac
+true
+""",
+    "du": """
+for last; do true; done
+printf '4096\\t%s\\n' "$last"
+""",
+    # a local stand-in: drop the options and the host, run the rest
+    "ssh": """
+while [ $# -gt 0 ]; do
+    case "$1" in
+        -T) shift ;;
+        -o) shift 2 ;;
+        *) shift; break ;;
+    esac
+done
+bash -c "$*"
+""",
+    "python": """
+echo "Python 3.11.0"
+""",
+    "mount": """
+[ $# -eq 0 ] && echo "/dev/mapper/bench-root on / type ext4 (rw,relatime)"
+true
+""",
+    "lvs": """
+echo "  bench root"
+""",
+    "lvcreate": "true\n",
+    "lvremove": "true\n",
+    "umount": "true\n",
+    "par2": "true\n",
+}
+
+
+def subcommand(argv):
+    """return the subcommand of a bup or git command line, skipping the
+    repository options"""
+    while argv and argv[0] in ("-d", "--git-dir", "--no-pager"):
+        argv = argv[1:] if argv[0] == "--no-pager" else argv[2:]
+    while argv and argv[0].startswith("--git-dir="):
+        argv = argv[1:]
+    return argv[0] if argv else ""
+
+
+class Toolchain(object):
+    """a temporary directory holding the stubs, the repository and the
+    call log"""
+
+    def __init__(self):
+        self.root = tempfile.mkdtemp(prefix="bup-cron-bench-")
+        self.bindir = os.path.join(self.root, "bin")
+        self.log = os.path.join(self.root, "calls.log")
+        self.repo = os.path.join(self.root, "repo.bup")
+        self.remote_repo = os.path.join(self.root, "remote.bup")
+        os.makedirs(self.bindir)
+        for name, body in stubs.items():
+            path = os.path.join(self.bindir, name)
+            with open(path, "w") as f:
+                f.write(stub_header + body)
+            os.chmod(path, 0o755)
+        for repo in [self.repo, self.remote_repo]:
+            os.makedirs(os.path.join(repo, "objects", "pack"))
+        os.environ["PATH"] = self.bindir + os.pathsep + os.environ["PATH"]
+        os.environ["BENCH_LOG"] = self.log
+        # do not pick up the configuration of the machine running this
+        os.environ["HOME"] = self.root
+        self.sources = []
+
+    def make_paths(self, count):
+        while len(self.sources) < count:
+            path = os.path.join(self.root, "src", "dir%d" % len(self.sources))
+            os.makedirs(path)
+            with open(os.path.join(path, "file"), "w") as f:
+                f.write("data")
+            self.sources.append(path)
+        return self.sources[:count]
+
+    def reset_log(self):
+        open(self.log, "w").close()
+
+    def calls(self):
+        """return a dict mapping commands to lists of latencies, and the
+        total time spent in commands bup-cron spawned directly"""
+        calls = {}
+        total = 0
+        with open(self.log) as f:
+            for line in f:
+                fields = line.rstrip("\n").split(" ", 4) + [""]
+                name, depth, start, end, rest = fields[:5]
+                if name in ("bup", "git"):
+                    name += " " + subcommand(rest.split())
+                latency = float(end.replace(",", ".")) - float(start.replace(",", "."))
+                calls.setdefault(name, []).append(latency)
+                if depth == "0":
+                    total += latency
+        return calls, total
+
+    def cleanup(self):
+        shutil.rmtree(self.root)
+
+
+def parse(argv):
+    """run bup-cron's own argument parser on the given argv"""
+    saved = sys.argv
+    sys.argv = ["bup-cron"] + argv
+    try:
+        return bup_cron.ArgumentConfigParser().parse_args()
+    finally:
+        sys.argv = saved
+
+
+def scenarios(toolchain, counts):
+    """yield (name, argv) tuples for every benchmarked configuration"""
+    remote = "localhost:" + toolchain.remote_repo
+    for count in counts:
+        paths = toolchain.make_paths(count)
+        base = ["-d", toolchain.repo, "--pidfile", os.path.join(toolchain.root, "pid")]
+        yield "local-%d" % count, base + paths
+        yield "local-stats-%d" % count, base + ["--stats"] + paths
+        yield "remote-stats-%d" % count, base + ["--stats", "-r", remote] + paths
+        yield "remote-check-parity-%d" % count, base + [
+            "--check",
+            "--parity",
+            "-r",
+            remote,
+        ] + paths
+        yield "lvm-%d" % count, base + ["--snapshot", "LVM"] + paths
+
+
+def set_logger(args):
+    """(re)initialise bup-cron's logger without piling up handlers"""
+    if bup_cron.global_logger is not None:
+        bup_cron.global_logger.stop()
+    logging.getLogger("").handlers = []
+    bup_cron.global_logger = bup_cron.GlobalLogger(args)
+    # snapshot probes warn about the fake devices, keep the output readable
+    logging.getLogger("").handlers[-1].setLevel(logging.ERROR)
+
+
+def bench(toolchain, argv, repeat):
+    """benchmark parsing and process() for one configuration"""
+    parse_times = []
+    process_times = []
+    for _ in range(repeat):
+        toolchain.reset_log()
+        start = time.perf_counter()
+        args = parse(argv)
+        parse_times.append(time.perf_counter() - start)
+        set_logger(args)
+        start = time.perf_counter()
+        bup_cron.process(args)
+        process_times.append(time.perf_counter() - start)
+    calls, child_time = toolchain.calls()
+    return {
+        "parse": min(parse_times),
+        "process": min(process_times),
+        "process_median": statistics.median(process_times),
+        "spawns": sum(len(v) for v in calls.values()),
+        "child_time": child_time,
+        "calls": {k: len(v) for k, v in sorted(calls.items())},
+        "latency": {k: statistics.mean(v) for k, v in sorted(calls.items())},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--paths",
+        default="1,10,100",
+        help="comma-separated path counts to benchmark, default: %(default)s",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=5,
+        help="runs per configuration, the best one is kept, default: %(default)s",
+    )
+    parser.add_argument(
+        "--json", action="store_true", help="output raw results as JSON"
+    )
+    args = parser.parse_args()
+    counts = [int(c) for c in args.paths.split(",")]
+
+    toolchain = Toolchain()
+    results = {}
+    try:
+        for name, argv in scenarios(toolchain, counts):
+            results[name] = bench(toolchain, argv, args.repeat)
+    finally:
+        toolchain.cleanup()
+
+    if args.json:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print()
+        return
+    print(
+        "%-26s %9s %11s %7s %11s %11s"
+        % ("scenario", "parse ms", "process ms", "spawns", "child ms", "own ms")
+    )
+    for name, r in results.items():
+        print(
+            "%-26s %9.2f %11.1f %7d %11.1f %11.1f"
+            % (
+                name,
+                r["parse"] * 1000,
+                r["process"] * 1000,
+                r["spawns"],
+                r["child_time"] * 1000,
+                (r["process"] - r["child_time"]) * 1000,
+            )
+        )
+    print()
+    print("calls per run (mean latency in ms):")
+    for name, r in results.items():
+        print(
+            "  %-26s %s"
+            % (
+                name,
+                ", ".join(
+                    "%s: %d (%.1f)" % (k, v, r["latency"][k] * 1000)
+                    for k, v in r["calls"].items()
+                ),
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
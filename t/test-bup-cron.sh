@@ -28,6 +28,12 @@ WVPASS cd "$tmpdir"
 # Can bup-cron be called
 WVPASS bup-cron -h >/dev/null
 
+# Startup stays cheap: modules only some features need are not
+# imported by monitoring probes
+WVPASSEQ "$(WVPASS "$top/bup-cron" --version)" "$(WVPASS python3 -c 'import sys; sys.path.insert(0, "'"$top"'"); import bup_cron; print(bup_cron.__version__)')"
+WVFAIL python3 -X importtime "$top/bup-cron" --version 2>&1 \
+    | grep -E '\| +(platform|socket|logging\.handlers|sqlite3)$'
+
 # Create some data to backup
 WVSTART "create src data"
 WVPASS mkdir -p "$tmpdir/src/"{dir1,dir2,dir1/x,dir1/x/a,dir/x/b}
@@ -63,6 +69,113 @@ WVPASSEQ "$(WVPASS ls "$tmpdir/dst/latest/")" "d20
 d21"
 WVPASS rm -fr "$tmpdir/dst"
 
+WVSTART "bup-cron: --paths-from and large exclude sets"
+branch_name="from-${tmpdir//\//_}_src_dir1"
+excludes="$(for i in $(seq 5000); do echo "--exclude=$tmpdir/src/none$i"; done)"
+echo "$tmpdir/src/dir1" | WVPASS bup-cron --name from --paths-from - \
+    $excludes --exclude="$tmpdir/src/dir1/x"
+WVPASSEQ "$(WVPASS bup ls /$branch_name/latest/)" "d10
+d11"
+
+WVSTART "bup-cron: --engine auto"
+branch_name="engine-${tmpdir//\//_}_src_dir2"
+WVPASS bup-cron --name engine --engine auto "$tmpdir/src/dir2"
+WVPASSEQ "$(WVPASS bup ls /$branch_name/latest/)" "d20
+d21"
+
+WVSTART "bup-cron: --compress and --pack-size-limit"
+WVPASS bup-cron --compress auto --pack-size-limit 1g "$tmpdir/src/dir1"
+WVPASSEQ "$(WVPASS git config pack.packSizeLimit)" "1g"
+WVFAIL bup-cron --compress 10 "$tmpdir/src/dir1"
+
+WVSTART "bup-cron: --preflight checks the free space"
+WVPASS date > "$tmpdir/src/dir1/d12"
+WVPASS bup-cron --preflight --stats "$tmpdir/src/dir1"
+WVPASS git notes show "$HOSTNAME-${tmpdir//\//_}_src_dir1" \
+    | WVPASS grep -q preflight_actual_bytes
+WVPASS rm "$tmpdir/src/dir1/d12"
+
+WVSTART "bup-cron: --profile writes profiles"
+WVPASS bup-cron --profile "$tmpdir/profile" "$tmpdir/src/dir1"
+WVPASS python3 -c 'import pstats, sys; pstats.Stats(sys.argv[1])' \
+    "$tmpdir/profile/bup-save.pstats"
+WVPASS grep -q "^bup-cron;process;bup-save;bup save [0-9]*$" \
+    "$tmpdir/profile/children.folded"
+
+WVSTART "bup-cron: --log-format json"
+WVPASS bup-cron -vv --log-format json --logfile "$tmpdir/log.json" \
+    "$tmpdir/src/dir1" 2> "$tmpdir/log.stderr"
+# the records go to --logfile, not to the console
+WVFAIL grep -q "^{" "$tmpdir/log.stderr"
+WVPASS python3 -c '
+import json, sys
+records = [json.loads(line) for line in open(sys.argv[1]) if line.startswith("{")]
+assert any(r.get("phase") == "bup-save" and r.get("rc") == 0 for r in records)
+' "$tmpdir/log.json"
+
+WVSTART "bup-cron: --maintain builds midx and bloom files"
+WVPASS bup-cron --maintain "$tmpdir/src/dir1"
+WVPASS test -f "$BUP_DIR/objects/pack/bup.bloom"
+
+WVSTART "bup-cron: --verify-rotate 1 verifies all packs"
+WVPASS bup-cron --verify-rotate 1 "$tmpdir/src/dir1"
+WVPASSEQ "$(WVPASS python3 -c 'import json, sys; print(len(json.load(open(sys.argv[1]))["local"]))' "$BUP_DIR/bup-cron-verified.json")" \
+    "$(ls "$BUP_DIR"/objects/pack/*.pack | wc -l)"
+
+WVSTART "bup-cron: --stall-timeout kills a hung bup save"
+WVPASS mkdir "$tmpdir/hang"
+cat > "$tmpdir/hang/bup" <<EOF
+#!/bin/sh
+[ "\$1" = save ] && exec sleep 600
+exec $(command -v bup) "\$@"
+EOF
+WVPASS chmod +x "$tmpdir/hang/bup"
+WVFAIL env PATH="$tmpdir/hang:$PATH" bup-cron --stall-timeout 1 \
+    --stall-retries 0 --stats-db "$tmpdir/src/dir1"
+WVPASS "$top/bup-cron" stats --metric watchdog_kills | WVPASS grep -q watchdog_kills
+WVFAIL pgrep -x -f "sleep 600"
+WVPASS bup-cron --timeout save=1h --stall-timeout 1h "$tmpdir/src/dir1"
+
+WVSTART "bup-cron: --interval only saves paths that are due"
+WVPASS bup-cron --interval "$tmpdir/src/dir2=1d" "$tmpdir/src/dir2"
+# the logs go to stderr
+WVPASS bup-cron -v --interval "$tmpdir/src/dir2=1d" "$tmpdir/src/dir2" 2>&1 \
+    | WVPASS grep -q "^skipping $tmpdir/src/dir2"
+WVPASS bup-cron -v --interval "$tmpdir/src/dir2=1d" --ignore-schedule \
+    "$tmpdir/src/dir2" 2>&1 | WVPASS grep -q "^saving $tmpdir/src/dir2"
+WVPASS bup-cron -v --interval "$tmpdir/src/dir2=1d" --ignore-schedule \
+    "$tmpdir/src/dir2" 2>&1 | WVFAIL grep -q "^skipping"
+
+WVSTART "bup-cron: --index-shards saves paths in parallel"
+WVPASS bup-cron --index-shards --parallel-paths 2 --name shards \
+    "$tmpdir/src/dir1" "$tmpdir/src/dir2"
+WVPASS test -s "$BUP_DIR/bupindex.d/${tmpdir//\//_}_src_dir1"
+WVPASS test -s "$BUP_DIR/bupindex.d/${tmpdir//\//_}_src_dir2"
+WVPASS bup ls "/shards-${tmpdir//\//_}_src_dir2/latest/" | WVPASS grep -q d20
+WVPASS bup-cron --index-shards --clear-path "$tmpdir/src/dir2" --name shards \
+    "$tmpdir/src/dir2"
+
+WVSTART "bup-cron: --exclude-caches skips tagged directories"
+WVPASS mkdir -p "$tmpdir/cached/cache"
+WVPASS date > "$tmpdir/cached/keep"
+WVPASS date > "$tmpdir/cached/cache/junk"
+WVPASS echo "Signature: 8a477f597d28d172789f06886806bc55" \
+    > "$tmpdir/cached/cache/CACHEDIR.TAG"
+WVPASS bup-cron --exclude-caches --name cached "$tmpdir/cached"
+WVPASSEQ "$(WVPASS bup ls "/cached-${tmpdir//\//_}_cached/latest/")" "keep"
+WVPASS date > "$tmpdir/cached/nodump"
+if chattr +d "$tmpdir/cached/nodump" 2>/dev/null; then
+    WVPASS bup-cron --exclude-caches --exclude-nodump --name cached "$tmpdir/cached"
+    WVPASSEQ "$(WVPASS bup ls "/cached-${tmpdir//\//_}_cached/latest/")" "keep"
+fi
+
+WVSTART "bup-cron: --memory-high measures the page cache"
+WVPASS date > "$tmpdir/src/dir1/d13"
+WVPASS bup-cron --memory-high 512M --stats "$tmpdir/src/dir1"
+WVPASS git notes show "$HOSTNAME-${tmpdir//\//_}_src_dir1" \
+    | WVPASS grep -q page_cache_after
+WVPASS rm "$tmpdir/src/dir1/d13"
+
 WVSTART "bup-cron: --parity generates parity blocks"
 branch_name="$HOSTNAME-${tmpdir//\//_}_src_dir1"
 WVPASS bup-cron --parity "$tmpdir/src/dir1"
@@ -89,10 +202,63 @@ WVFAIL bup-cron --parity --repair "$tmpdir/src/dir1"
 WVPASS bup fsck
 WVPASS bup-cron --parity --check "$tmpdir/src/dir1"
 
+WVSTART "bup-cron: --pipe streams command output into bup split"
+WVPASS bup-cron --name pipes --pipe "dates=cat $tmpdir/src/dir1/d10"
+WVPASSEQ "$(WVPASS bup join pipes-pipe-dates)" "$(cat "$tmpdir/src/dir1/d10")"
+WVFAIL bup-cron --name pipes --pipe "failing=echo partial; false"
+WVFAIL git rev-parse --verify -q pipes-pipe-failing
+
+WVSTART "bup-cron: --job-file runs all jobs"
+cat > "$tmpdir/jobs.conf" <<EOF
+name=jobs
+
+[dir1]
+path=$tmpdir/src/dir1
+
+[dir2]
+path=$tmpdir/src/dir2
+after=dir1
+EOF
+WVPASS bup-cron --job-file "$tmpdir/jobs.conf" --parallel-jobs 2
+WVPASS bup ls "/jobs-${tmpdir//\//_}_src_dir1/latest"
+WVPASS bup ls "/jobs-${tmpdir//\//_}_src_dir2/latest"
+
+WVSTART "bup-cron: --verify-sample restores and compares files"
+WVPASS bup-cron --verify-sample 3 "$tmpdir/src/dir1"
+WVPASS bup-cron --name verify --stats --verify-sample 3 "$tmpdir/src/dir2"
+WVPASS git notes show "verify-${tmpdir//\//_}_src_dir2" | WVPASS grep -q restore_mbps
+# excluded files are not saved, so they must not be sampled
+WVPASS mkdir -p "$tmpdir/verify/skip"
+WVPASS date > "$tmpdir/verify/keep"
+for i in 1 2 3 4 5; do WVPASS date > "$tmpdir/verify/skip/f$i"; done
+WVPASS bup-cron -v --name verify --exclude "$tmpdir/verify/skip" --verify-sample 10 \
+    "$tmpdir/verify" 2>&1 | WVPASS grep -q "verified 1 files .* 0 failures"
+
+WVSTART "bup-cron: --keep-daily prunes old saves"
+branch_name=prune-${tmpdir//\//_}_src_dir2
+WVPASS bup index "$tmpdir/src/dir2"
+for days in 3 2 1; do
+    WVPASS bup save -d $(( $(date +%s) - days * 86400 )) -n "$branch_name" \
+        --strip "$tmpdir/src/dir2"
+done
+WVPASS bup-cron --name prune --keep-daily 2 --prune-dry-run "$tmpdir/src/dir2"
+WVPASSEQ "$(WVPASS bup ls "/$branch_name" | grep -vc latest)" "4"
+WVPASS bup-cron --name prune --keep-daily 2 "$tmpdir/src/dir2"
+WVPASSEQ "$(WVPASS bup ls "/$branch_name" | grep -vc latest)" "2"
+
 WVSTART "bup-cron: --stats generates git notes, the last one with content"
 branch_name=stats-${tmpdir//\//_}_src_dir2
 WVPASS bup-cron --name stats --stats "$tmpdir/src/dir2"
 WVPASS git show $branch_name
+WVPASS git notes show $branch_name | WVPASS grep -q "save_scanned_bytes"
+
+WVSTART "bup-cron: --stats-db records runs and imports notes"
+branch_name=statsdb-${tmpdir//\//_}_src_dir2
+WVPASS bup-cron --name statsdb --stats-db "$tmpdir/src/dir2"
+WVPASS test -f "$BUP_DIR/bup-cron-stats.sqlite"
+WVPASS "$top/bup-cron" stats --metric size_diff | WVPASS grep -q "^$branch_name"
+WVPASS rm "$BUP_DIR/bup-cron-stats.sqlite"
+WVPASS "$top/bup-cron" stats --import | WVPASS grep -q "^$branch_name"
 
 WVSTART "bup-cron: test remote host support in $HOST:$BUP_DIR"
 branch_name=remote-${tmpdir//\//_}_src_dir1
@@ -106,6 +272,60 @@ branch_name=remote-${tmpdir//\//_}_src_dir1
 WVPASS bup-cron --name remote --stats -r $HOST:$BUP_DIR "$tmpdir/src/dir1"
 WVPASS git notes show $branch_name
 
+WVSTART "bup-cron: --remote-queue checks on the server"
+# the worker is started by hand, to find the job in the queue
+WVPASS bup-cron --name remote -r $HOST:$BUP_DIR --remote-queue "$tmpdir/queue" \
+    --no-start-worker --check "$tmpdir/src/dir1"
+WVPASSEQ "$(find "$tmpdir/queue" -name "*.json" | wc -l)" "1"
+WVPASS bup-cron --server-worker "$tmpdir/queue"
+WVPASSEQ "$(ls "$tmpdir/queue/done" | wc -l)" "1"
+WVPASS bup-cron -v --name remote -r $HOST:$BUP_DIR --remote-queue "$tmpdir/queue" \
+    --no-start-worker "$tmpdir/src/dir1" 2>&1 \
+    | WVPASS grep -q "remote check queued on .* succeeded"
+WVPASSEQ "$(ls "$tmpdir/queue/done" | wc -l)" "0"
+
+if [ "$(id -u)" = 0 ] && command -v fsfreeze >/dev/null \
+        && command -v mkfs.ext4 >/dev/null; then
+    WVSTART "bup-cron: --snapshot FREEZE backs up a frozen loop filesystem"
+    WVPASS truncate -s 64M "$tmpdir/freeze.img"
+    WVPASS mkfs.ext4 -q "$tmpdir/freeze.img"
+    WVPASS mkdir "$tmpdir/freeze"
+    WVPASS mount -o loop "$tmpdir/freeze.img" "$tmpdir/freeze"
+    WVPASS date > "$tmpdir/freeze/d1"
+    WVPASS bup-cron --name freeze --snapshot FREEZE \
+        --mountpoint "$tmpdir/mnt/%s-%s" "$tmpdir/freeze"
+    branch_name=freeze-${tmpdir//\//_}_freeze
+    WVPASSEQ "$(WVPASS bup ls /$branch_name/latest/)" "d1
+lost+found"
+    # thawed again
+    WVPASS touch "$tmpdir/freeze/d2"
+    WVPASS umount "$tmpdir/freeze"
+fi
+
+if [ "$(id -u)" = 0 ] && command -v lvcreate >/dev/null \
+        && command -v mkfs.ext4 >/dev/null; then
+    WVSTART "bup-cron: --snapshot LVMTHIN backs up a thin loop volume"
+    vg=bupcron$$
+    WVPASS truncate -s 256M "$tmpdir/thin.img"
+    loop="$(WVPASS losetup --find --show "$tmpdir/thin.img")" || exit $?
+    WVPASS vgcreate -q $vg "$loop"
+    WVPASS lvcreate -q -L 128M -T $vg/pool
+    WVPASS lvcreate -q -V 64M -T $vg/pool -n origin
+    WVPASS mkfs.ext4 -q /dev/$vg/origin
+    WVPASS mkdir "$tmpdir/thin"
+    WVPASS mount /dev/$vg/origin "$tmpdir/thin"
+    WVPASS date > "$tmpdir/thin/d1"
+    WVPASS bup-cron --name thin --snapshot LVMTHIN \
+        --mountpoint "$tmpdir/mnt/%s-%s" "$tmpdir/thin"
+    branch_name=thin-${tmpdir//\//_}_thin
+    WVPASSEQ "$(WVPASS bup ls /$branch_name/latest/)" "d1
+lost+found"
+    WVFAIL lvs $vg/snaporigin
+    WVPASS umount "$tmpdir/thin"
+    WVPASS vgremove -q -f $vg
+    WVPASS losetup -d "$loop"
+fi
+
 # MISSING TESTS:
 # * logfile
 # * syslog
@@ -114,7 +334,7 @@ WVPASS git notes show $branch_name
 # * pidfile
 # if ROOT:
 # - test snapshot
-#	- lvm
+#	- classic lvm
 #	- VSS
 
 WVPASS rm -fr "$tmpdir"